@@ -0,0 +1,56 @@
+from __future__ import annotations
+import os, json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, List, Tuple
+
+# 输出档位：决定除 JSON 以外还生成哪些产物（JSON 总是生成）
+PROFILES: Dict[str, Tuple[str, ...]] = {
+    "minimal":  (),
+    "clinical": ("overlay", "report_pro", "report_easy", "preview"),
+    "research": ("image", "mask", "overlay", "report_pro", "report_easy", "preview"),
+}
+DEF_PROFILE = "research"
+
+def write_json_durable(path: Path, obj: Any):
+    """写 JSON：先写临时文件并 fsync，再原子替换；返回时内容已落盘。"""
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def write_text(path: Path, text: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+class AsyncExporter:
+    """
+    后台线程并发写产物（NIfTI / PNG / 文本报告），主流程不必等待。
+    压缩、编码、写盘大多释放 GIL，少量线程就能把 I/O 叠起来。
+    """
+    def __init__(self, max_workers: int = 3):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self._jobs: List[Tuple[str, Future]] = []
+
+    def submit(self, name: str, fn: Callable, *args, **kwargs) -> Future:
+        fut = self._pool.submit(fn, *args, **kwargs)
+        self._jobs.append((name, fut))
+        return fut
+
+    def wait(self) -> List[Tuple[str, BaseException]]:
+        """等待已提交的产物写完，返回失败列表 [(名称, 异常)]。"""
+        failed = []
+        for name, fut in self._jobs:
+            exc = fut.exception()
+            if exc is not None:
+                failed.append((name, exc))
+        self._jobs.clear()
+        return failed
+
+    def close(self) -> List[Tuple[str, BaseException]]:
+        failed = self.wait()
+        self._pool.shutdown(wait=True)
+        return failed
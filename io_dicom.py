@@ -5,7 +5,18 @@ import numpy as np
 import pydicom
 import nibabel as nib
 
-def _load_dicom_series(folder: Path) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+from utils import INT16_MIN, INT16_MAX, to_int16_if_lossless
+
+def _hu_int16(arr: np.ndarray, slope: float, inter: float) -> Optional[np.ndarray]:
+    """slope/intercept 为整数且结果在 int16 范围内时，直接用整数算 HU；否则返回 None"""
+    if not (float(slope).is_integer() and float(inter).is_integer()):
+        return None
+    hu = arr.astype(np.int32) * int(slope) + int(inter)
+    if hu.size and (hu.min() < INT16_MIN or hu.max() > INT16_MAX):
+        return None
+    return hu.astype(np.int16)
+
+def _load_dicom_series(folder: Path, compact: bool=False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
     dcm_files: List[Path] = sorted([p for p in folder.rglob("*.dcm") if p.is_file()])
     if not dcm_files:
         # 有些厂商无后缀，尝试所有文件中过滤 DICOM
@@ -47,36 +58,45 @@ def _load_dicom_series(folder: Path) -> Tuple[np.ndarray, Optional[np.ndarray]]:
         # Hounsfield 估算
         slope = float(getattr(ds, "RescaleSlope", 1.0))
         inter = float(getattr(ds, "RescaleIntercept", 0.0))
-        hu = arr * slope + inter
+        hu = _hu_int16(arr, slope, inter) if compact else None
+        if hu is None:
+            hu = arr * slope + inter
         slices.append(hu)
-    vol = np.stack(slices, axis=0)  # [Z, H, W]
 
     # affine 简单设置（非严格，演示用）
     affine = np.eye(4, dtype=float)
+    if compact and all(s.dtype == np.int16 for s in slices):
+        # 紧凑模式：整卷保持 int16（每体素 2 字节）
+        return np.stack(slices, axis=0), affine
+    vol = np.stack(slices, axis=0)  # [Z, H, W]
     return vol.astype(np.float32), affine
 
-def _load_nii(nii_path: Path) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+def _load_nii(nii_path: Path, compact: bool=False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
     img = nib.load(str(nii_path))
-    data = img.get_fdata().astype(np.float32)
-    arr = np.asarray(data)
+    if compact:
+        # 取存储 dtype（已套用 scl_slope/scl_inter），能无损放进 int16 就不转浮点
+        arr = to_int16_if_lossless(np.asanyarray(img.dataobj))
+    else:
+        arr = np.asarray(img.get_fdata().astype(np.float32))
     # nib 为 [H,W,Z]，统一转 [Z,H,W]
     vol = np.transpose(arr, (2,0,1))
     return vol, img.affine
 
-def load_any(input_path: Path) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+def load_any(input_path: Path, compact: bool=False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
     """
     支持：
       - DICOM 文件夹
       - 打包的 ZIP（内含 DICOM 序列）
       - NIfTI (.nii / .nii.gz)
     返回：volume [Z,H,W]，affine（NIfTI 时可用）
+    compact=True 时 HU 能无损表示就保持 int16，否则仍为 float32
     """
     input_path = Path(input_path)
     if not input_path.exists():
         raise FileNotFoundError(f"{input_path} 不存在")
 
     if input_path.suffix.lower() in [".nii", ".gz", ".nii.gz"]:
-        return _load_nii(input_path)
+        return _load_nii(input_path, compact=compact)
 
     if input_path.is_file() and input_path.suffix.lower() == ".zip":
         from utils import extract_zip
@@ -85,9 +105,9 @@ def load_any(input_path: Path) -> Tuple[np.ndarray, Optional[np.ndarray]]:
             # 清理旧目录
             import shutil; shutil.rmtree(tmp, ignore_errors=True)
         extract_zip(input_path, tmp)
-        return _load_dicom_series(tmp)
+        return _load_dicom_series(tmp, compact=compact)
 
     if input_path.is_dir():
-        return _load_dicom_series(input_path)
+        return _load_dicom_series(input_path, compact=compact)
 
     raise ValueError(f"无法识别的输入：{input_path}")
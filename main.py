@@ -10,13 +10,17 @@ Banana — 单次推理入口（双报告版）
 注意：Windows 路径请用引号包住，或使用反斜杠转义已由 argparse 处理。
 """
 
-import os, sys, json, math, time, argparse
+import os, sys, math, time, argparse, tracemalloc
 from pathlib import Path
 
 import numpy as np
 import nibabel as nib
 import SimpleITK as sitk
 
+from export import PROFILES, DEF_PROFILE, AsyncExporter, write_json_durable, write_text
+from preview import build_preview, DEF_PREVIEW_STEP, DEF_PREVIEW_SIZE
+from utils import to_int16_if_lossless
+
 # ------------ 可选依赖（没有也能跑，只是会少做连通域清理） ------------
 try:
     from scipy import ndimage as ndi
@@ -30,6 +34,9 @@ DEF_SOFT_HU  = (-250.0, 200.0)    # 参与筛选的软阈 HU
 DEF_TOP_PCT  = 0.60               # 取top百分位作为初阈值
 DEF_Z_SMOOTH = 1                  # z 方向平滑（示意位）
 DEF_MIN_AREA = 80                 # 连通域最小体素
+DEF_MAX_LESIONS = 100             # JSON 中病灶表最多列出的组件数
+_METRIC_CHUNK   = 1 << 18         # 病灶指标每块处理的体素数上限
+NII_TO_ZHW = (2, 0, 1)            # NIfTI [i,j,k] 把 k 轴挪到最前后，[Z,H,W] 依次是原来的 k,i,j 轴
 
 # ------------ 日志辅助 ------------
 def log(msg: str):
@@ -37,11 +44,20 @@ def log(msg: str):
     print(f"[{now}] {msg}")
 
 # ------------ I/O：读取 zip/DICOM/nii(.gz) ------------
-def load_any(input_path: Path):
+def reorder_affine(affine: np.ndarray, axes: tuple[int, int, int]) -> np.ndarray:
+    """
+    数组轴重排后（新第 n 轴 = 原第 axes[n] 轴），把 affine 的列同步换序，
+    使它仍把新数组的体素下标映射到同一个 mm 位置。
+    """
+    out = np.array(affine, copy=True)
+    out[:, :3] = np.asarray(affine)[:, list(axes)]
+    return out
+
+def load_any(input_path: Path, compact: bool = False):
     """
     返回：
-      vol: np.float32, 形状 [Z,H,W]（CT 的 HU 值）
-      affine: 4x4 仿射（没有就造一个1mm各向同性）
+      vol: np.float32, 形状 [Z,H,W]（CT 的 HU 值）；compact=True 时能无损就保持 int16
+      affine: 4x4 仿射（没有就造一个1mm各向同性），作用在 [Z,H,W] 下标上
     """
     p = Path(input_path)
     if not p.exists():
@@ -50,12 +66,17 @@ def load_any(input_path: Path):
     # 1) 直接 NIfTI
     if p.suffix.lower() in [".nii", ".gz", ".mgz", ".mgh"] or p.name.endswith(".nii.gz"):
         img = nib.load(str(p))
-        vol = np.asarray(img.get_fdata()).astype(np.float32)
+        if compact:
+            # 直接取存储 dtype（带 scl_slope/inter 时 nibabel 会自行换算成浮点）
+            vol = to_int16_if_lossless(np.asanyarray(img.dataobj))
+        else:
+            vol = np.asarray(img.get_fdata()).astype(np.float32)
         affine = img.affine.astype(np.float32)
         # 兼容 [H,W,Z] or [Z,H,W]：统一成 [Z,H,W]
         if vol.shape[0] != min(vol.shape):
-            # 约定 NIfTI 常为 [H,W,Z]，这里转为 [Z,H,W]
+            # 约定 NIfTI 常为 [H,W,Z]，这里转为 [Z,H,W]；affine 跟着换序，质心/导出才在正确坐标系里
             vol = np.moveaxis(vol, -1, 0)
+            affine = reorder_affine(affine, NII_TO_ZHW)
         return vol, affine
 
     # 2) DICOM 文件夹（或zip解压出的文件夹）
@@ -66,7 +87,8 @@ def load_any(input_path: Path):
             raise FileNotFoundError("未在目录中找到 DICOM 序列")
         reader.SetFileNames(dicom_names)
         img = reader.Execute()
-        vol = sitk.GetArrayFromImage(img).astype(np.float32)  # [Z,H,W]
+        vol = sitk.GetArrayFromImage(img)  # [Z,H,W]
+        vol = to_int16_if_lossless(vol) if compact else vol.astype(np.float32)
         # 构造affine（近似）：spacing 放对，方向不强依赖
         sp = img.GetSpacing()           # (sx, sy, sz)
         origin = img.GetOrigin()        # (ox, oy, oz)
@@ -81,17 +103,18 @@ def load_any(input_path: Path):
     # 3) zip：解压到临时目录后走 DICOM 文件夹逻辑
     if p.suffix.lower() == ".zip":
         import zipfile, tempfile
-        tmpdir = Path(tempfile.mkdtemp(prefix="banana_"))
-        with zipfile.ZipFile(str(p), "r") as zf:
-            zf.extractall(tmpdir)
-        # 尝试寻找包含 .dcm 的最内层目录
-        cand = None
-        for root, _, files in os.walk(tmpdir):
-            if any(f.lower().endswith(".dcm") for f in files):
-                cand = Path(root); break
-        if cand is None:
-            raise FileNotFoundError("zip 内未发现 DICOM 文件（*.dcm）")
-        return load_any(cand)
+        # 解压目录只在读取期间存在；SimpleITK 读出的数组已在内存里，不引用这些文件
+        with tempfile.TemporaryDirectory(prefix="banana_") as tmpdir:
+            with zipfile.ZipFile(str(p), "r") as zf:
+                zf.extractall(tmpdir)
+            # 尝试寻找包含 .dcm 的最内层目录
+            cand = None
+            for root, _, files in os.walk(tmpdir):
+                if any(f.lower().endswith(".dcm") for f in files):
+                    cand = Path(root); break
+            if cand is None:
+                raise FileNotFoundError("zip 内未发现 DICOM 文件（*.dcm）")
+            return load_any(cand, compact=compact)
 
     raise ValueError(f"不支持的输入：{p}")
 
@@ -116,10 +139,18 @@ def silver_mask(vol_hu: np.ndarray,
                 soft_hu: tuple[float, float],
                 top_percent: float,
                 z_smooth_k: int,
-                min_area: int):
+                min_area: int,
+                compact: bool = False,
+                return_labels: bool = False):
     """
     返回二值 mask（uint8，0/1），形状与 vol_hu 一致
+    compact=True 时走 silver_mask_compact，返回 bool mask
+    return_labels=True 时额外返回连通域步骤的标签卷及组件数：(mask, thr, lab, n)，
+    lab 中保留下来的组件依次编号为 1..n
     """
+    if compact:
+        return silver_mask_compact(vol_hu, soft_hu, top_percent, z_smooth_k, min_area,
+                                   return_labels=return_labels)
     lo, hi = soft_hu
     v = np.clip(vol_hu, lo, hi)
     # 百分位阈值
@@ -140,28 +171,196 @@ def silver_mask(vol_hu: np.ndarray,
     if _HAS_SCIPY and min_area > 0:
         lab, nlab = ndi.label(init > 0)
         sizes = np.bincount(lab.ravel())
-        remove_ids = np.where(sizes < min_area)[0]
-        # 0 是背景，跳过
-        for rid in remove_ids:
-            if rid == 0: continue
-            init[lab == rid] = 0
-
+        # 小于 min_area 的组件一次查表清掉（0 是背景，本来就是 0）
+        init[(sizes < min_area)[lab]] = 0
+        if return_labels:
+            lab, n = relabel_kept(lab, sizes >= min_area)
+            return init, float(thr), lab, n
+
+    if return_labels:
+        return (init, float(thr)) + label_mask(init)
     return init, float(thr)
 
+# ------------ 连通域标签 ------------
+def relabel_kept(lab: np.ndarray, keep: np.ndarray) -> tuple[np.ndarray, int]:
+    """按 keep（按旧标签索引的 bool 表）去掉组件，并把保留的组件压缩编号为 1..n"""
+    keep = keep.copy()
+    keep[0] = False
+    remap = np.zeros(keep.size, dtype=np.int32)
+    n = int(keep.sum())
+    remap[keep] = np.arange(1, n + 1, dtype=np.int32)
+    return remap[lab], n
+
+def label_mask(mask: np.ndarray) -> tuple[np.ndarray, int]:
+    """没走连通域清理时补一次标签；没有 SciPy 就把整个掩膜当作一个组件"""
+    if _HAS_SCIPY:
+        lab, n = ndi.label(mask > 0)
+        return lab, int(n)
+    lab = (mask > 0).astype(np.int32)
+    return lab, int(lab.any())
+
+def quantile_inplace(x: np.ndarray, q: float) -> float:
+    """
+    与 np.quantile(x, q)（默认 linear 插值）相同，但在 x 上原地 partition，
+    不会像 np.quantile 那样为整数数组再建一份 float64 副本。
+    """
+    if x.size == 0:
+        raise ValueError("quantile of empty array")
+    pos = q * (x.size - 1)
+    i = int(math.floor(pos))
+    j = min(i + 1, x.size - 1)
+    x.partition([i, j] if j != i else i)
+    a, b = float(x[i]), float(x[j])
+    t = pos - i
+    # 与 numpy 的 _lerp 一致：t>=0.5 时从 b 端回推，减少舍入误差
+    return b - (b - a) * (1.0 - t) if t >= 0.5 else a + (b - a) * t
+
+def silver_mask_compact(vol_hu: np.ndarray,
+                        soft_hu: tuple[float, float],
+                        top_percent: float,
+                        z_smooth_k: int,
+                        min_area: int,
+                        return_labels: bool = False):
+    """
+    与 silver_mask 结果一致的低内存版本：
+    - 不生成整卷的 clip 浮点副本，只对 (lo, +∞) 的体素取分位
+      （clip 后 v>=thr 等价于原值 >=thr，因为 thr 落在 (lo, hi] 内）
+    - 掩膜全程 bool，连通域清理用查表一次完成
+    返回：(bool mask, 阈值)；return_labels=True 时为 (bool mask, 阈值, 标签卷, 组件数)
+    """
+    lo, hi = soft_hu
+    sel = vol_hu[vol_hu > lo]
+    if sel.dtype.kind == "f" or float(hi).is_integer():
+        np.minimum(sel, hi, out=sel, casting="unsafe")
+    else:
+        sel = np.minimum(sel, hi)       # 非整数上界：这一小段退回浮点
+    thr = quantile_inplace(sel, 1.0 - top_percent)
+    del sel
+    init = vol_hu >= thr
+
+    # z 向多数投票（计数用 uint8 足够）
+    if z_smooth_k > 1:
+        k = max(1, int(z_smooth_k))
+        pad = k // 2
+        padded = np.pad(init, ((pad, pad), (0, 0), (0, 0)), constant_values=False)
+        acc = np.zeros(init.shape, dtype=np.uint8 if k < 256 else np.int32)
+        for dz in range(k):
+            acc += padded[dz:dz+init.shape[0], :, :]
+        del padded
+        init = acc >= (k+1)//2
+        del acc
+
+    # 连通域清理：按组件大小建查表，一次索引去掉小块
+    if _HAS_SCIPY and min_area > 0:
+        lab, nlab = ndi.label(init)
+        keep = np.bincount(lab.ravel()) >= min_area
+        keep[0] = False
+        if return_labels:
+            lab, n = relabel_kept(lab, keep)
+            return lab > 0, thr, lab, n
+        init = keep[lab]
+        del lab
+
+    if return_labels:
+        return (init, thr) + label_mask(init)
+    return init, thr
+
+# ------------ 病灶（连通域）级指标 ------------
+def lesion_metrics(lab: np.ndarray, n: int, vol_hu: np.ndarray,
+                   affine: np.ndarray | None, vox_mm3: float,
+                   top: int | None = None) -> list[dict]:
+    """
+    对标签卷 lab（1..n）一次性计算每个组件的指标，按体积从大到小排序：
+      体素数 / 体积(ml) / 包围盒 [start, stop)（[Z,H,W] 体素下标）/
+      质心(mm，经 affine；affine 须作用在 [Z,H,W] 下标上，load_any 返回的即是) /
+      平均与最大 HU / 等体积球直径(mm)
+    只在前景体素上做一遍（按 z 分块以控制内存）：计数、HU 和、坐标和用 bincount；
+    最大 HU 与包围盒在按标签排序后用 reduceat 分段求，组件再多也没有逐个组件的循环。
+    top 给定时只输出体积最大的前 top 个。
+    """
+    if n <= 0:
+        return []
+    Z, H, W = lab.shape
+    counts = np.zeros(n+1, dtype=np.int64)
+    hu_sum = np.zeros(n+1)
+    c_sum  = np.zeros((n+1, 3))
+    hu_max = np.full(n+1, -np.inf)
+    bb_lo  = np.full((n+1, 3), np.iinfo(np.int64).max)
+    bb_hi  = np.full((n+1, 3), -1, dtype=np.int64)
+
+    # 按 z 向分块，临时数组（坐标、排序下标）只随块大小增长
+    slab = max(1, _METRIC_CHUNK // max(1, H * W))
+    for z0 in range(0, Z, slab):
+        sub = lab[z0:z0+slab]
+        fg = sub > 0
+        if not fg.any():
+            continue
+        l = sub[fg]
+        hu = vol_hu[z0:z0+slab][fg]
+        zyx = np.nonzero(fg)                 # 与 l 同序（C 序）
+        zyx = (zyx[0] + z0,) + zyx[1:]
+        del fg
+
+        counts += np.bincount(l, minlength=n+1)
+        hu_sum += np.bincount(l, weights=hu, minlength=n+1)
+        for a, c in enumerate(zyx):
+            c_sum[:, a] += np.bincount(l, weights=c, minlength=n+1)
+
+        order = np.argsort(l, kind="stable")
+        ls = l[order]
+        starts = np.flatnonzero(np.r_[True, ls[1:] != ls[:-1]])
+        ids = ls[starts]
+        hu_max[ids] = np.maximum(hu_max[ids], np.maximum.reduceat(hu[order], starts))
+        for a, c in enumerate(zyx):
+            c = c[order]
+            bb_lo[ids, a] = np.minimum(bb_lo[ids, a], np.minimum.reduceat(c, starts))
+            bb_hi[ids, a] = np.maximum(bb_hi[ids, a], np.maximum.reduceat(c, starts) + 1)
+
+    counts, hu_sum, hu_max = counts[1:], hu_sum[1:], hu_max[1:]
+    bb_lo, bb_hi = bb_lo[1:], bb_hi[1:]
+    cen_vox = c_sum[1:] / np.maximum(counts, 1)[:, None]
+
+    A = np.asarray(affine, dtype=np.float64) if affine is not None else np.eye(4)
+    cen_mm = cen_vox @ A[:3, :3].T + A[:3, 3]
+
+    vol_mm3 = counts * float(vox_mm3)
+    eq_d_mm = np.cbrt(6.0 * vol_mm3 / math.pi)
+
+    rank = np.argsort(-counts, kind="stable")[:top]
+    out = []
+    for r, i in enumerate(rank, 1):
+        out.append({
+            "rank": r,
+            "label": int(i + 1),
+            "voxels": int(counts[i]),
+            "volume_ml": float(vol_mm3[i] / 1000.0),
+            "bbox_zhw": [[int(bb_lo[i, a]), int(bb_hi[i, a])] for a in range(3)],
+            "centroid_mm": [round(float(c), 2) for c in cen_mm[i]],
+            "hu_mean": float(hu_sum[i] / counts[i]),
+            "hu_max": float(hu_max[i]),
+            "equiv_diameter_mm": float(eq_d_mm[i]),
+        })
+    return out
+
 # ------------ 叠图（取中间层） ------------
-def save_overlay_mid(vol01: np.ndarray, mask01: np.ndarray, out_png: Path):
+def save_overlay_mid(vol01: np.ndarray, mask01: np.ndarray, out_png: Path,
+                     win: tuple[float, float] | None = None):
+    """
+    win 为 None 时 vol01 是已归一化的整卷；给定 win 时 vol01 为原始 HU，
+    只对要画的那一层做窗宽归一化（省掉整卷浮点副本）。
+    """
     z = vol01.shape[0] // 2
-    import matplotlib
-    matplotlib.use("Agg")
-    import matplotlib.pyplot as plt
-    plt.figure(figsize=(6,6))
-    plt.imshow(vol01[z], cmap="gray")
-    plt.imshow(mask01[z], cmap="Reds", alpha=0.35)
-    plt.title(f"Overlay @ z={z}  img={tuple(vol01.shape)}  pred={tuple(mask01.shape)}")
-    plt.axis("off")
-    plt.tight_layout()
-    plt.savefig(out_png, dpi=120)
-    plt.close()
+    sl = normalize_to_01(vol01[z], win) if win is not None else vol01[z]
+    # 用面向对象的 Figure 而不是 pyplot 全局状态：可以在导出线程里安全调用
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(6,6))
+    ax = fig.add_subplot()
+    ax.imshow(sl, cmap="gray")
+    ax.imshow(mask01[z], cmap="Reds", alpha=0.35)
+    ax.set_title(f"Overlay @ z={z}  img={tuple(vol01.shape)}  pred={tuple(mask01.shape)}")
+    ax.axis("off")
+    fig.tight_layout()
+    fig.savefig(out_png, dpi=120)
 
 # ------------ 风险评级 & 大小类比 & 建议 ------------
 def risk_str(volume_ml: float, clean_voxels: int) -> tuple[str, float]:
@@ -205,11 +404,15 @@ def easy_recommendation(risk_level: str) -> str:
         return "建议预约门诊复查，完善增强CT或MRI随访；结合肿瘤标志物、病史综合判断。"
     return "建议常规随访或结合症状与既往史评估；如有不适请及时就诊。"
 
-# ------------ 主流程 ------------
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--input", required=True, help="DICOM打包zip / DICOM文件夹 / .nii/.nii.gz")
-    ap.add_argument("--out",   required=True, help="输出目录")
+# ------------ 命令行参数 ------------
+def positive_int(s: str) -> int:
+    v = int(s)
+    if v < 1:
+        raise argparse.ArgumentTypeError(f"需要 >= 1 的整数：{s}")
+    return v
+
+def add_pipeline_args(ap: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """流水线参数（单次推理与 watch 模式共用）"""
     ap.add_argument("--hu_lo",    type=float, default=DEF_HU_WIN[0])
     ap.add_argument("--hu_hi",    type=float, default=DEF_HU_WIN[1])
     ap.add_argument("--soft_lo",  type=float, default=DEF_SOFT_HU[0])
@@ -217,57 +420,192 @@ def main():
     ap.add_argument("--top_percent", type=float, default=DEF_TOP_PCT)
     ap.add_argument("--z_smooth",   type=int,   default=DEF_Z_SMOOTH)
     ap.add_argument("--min_area",   type=int,   default=DEF_MIN_AREA)
+    ap.add_argument("--max_lesions", type=positive_int, default=DEF_MAX_LESIONS,
+                    help="_report.json 病灶表最多列出的组件数（按体积排序）")
+    ap.add_argument("--compact", action="store_true",
+                    help="紧凑内存模式：HU 保持 int16、掩膜用 bool，只对渲染的层做窗宽")
+    ap.add_argument("--trace_mem", action="store_true",
+                    help="用 tracemalloc 统计各阶段峰值内存（有额外开销，调优时再开）")
+    ap.add_argument("--profile", choices=sorted(PROFILES), default=DEF_PROFILE,
+                    help="输出档位：minimal 仅 JSON；clinical 加叠图、文字报告与切片预览；research 再加 NIfTI")
+    ap.add_argument("--preview_step", type=int, default=DEF_PREVIEW_STEP, help="切片预览每隔几层取一层")
+    ap.add_argument("--preview_size", type=int, default=DEF_PREVIEW_SIZE, help="切片预览缩略图最长边（像素）")
+    ap.add_argument("--preview_sprite", action="store_true", help="额外输出平铺的 PNG 拼图")
+    return ap
+
+def report_export_failures(failed: list):
+    for name, exc in failed:
+        log(f"⚠ 产物导出失败：{name}  {exc}")
+
+# ------------ 主流程 ------------
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", required=True, help="DICOM打包zip / DICOM文件夹 / .nii/.nii.gz")
+    ap.add_argument("--out",   required=True, help="输出目录")
+    add_pipeline_args(ap)
     args = ap.parse_args()
+    exporter = AsyncExporter()
+    process_case(Path(args.input), Path(args.out), args, exporter=exporter)
+    report_export_failures(exporter.close())
 
-    inp   = Path(args.input)
-    outd  = Path(args.out); outd.mkdir(parents=True, exist_ok=True)
+def process_case(inp: Path, outd: Path, args: argparse.Namespace,
+                 exporter: AsyncExporter | None = None) -> Path:
+    """
+    跑一个病例的完整流水线，产物写入 outd。
+    args 需包含 add_pipeline_args 定义的参数。
+    JSON 同步落盘后即视为病例完成；其余产物交给 exporter 在后台写。
+    不传 exporter 时内部建一个，并在返回前等它写完。
+    返回：*_report.json 路径
+    """
+    inp   = Path(inp)
+    outd  = Path(outd); outd.mkdir(parents=True, exist_ok=True)
 
     stamp = time.strftime("%Y%m%d_%H%M%S")
     case  = inp.stem.replace(" ", "_")
     prefix = f"{case}_{stamp}"
+    compact = bool(getattr(args, "compact", False))
+    profile = getattr(args, "profile", DEF_PROFILE)
+    wanted  = set(PROFILES[profile])
+
+    # 峰值内存统计（numpy 的数组分配也会被 tracemalloc 记到）；有开销，只在 --trace_mem 时开
+    trace = bool(getattr(args, "trace_mem", False))
+    own_trace = trace and not tracemalloc.is_tracing()
+    if own_trace:
+        tracemalloc.start()
+    if trace:
+        tracemalloc.reset_peak()
+
+    def _peak() -> int | None:
+        return tracemalloc.get_traced_memory()[1] if trace else None
 
     # 1) 读取体积
     log(f"[1] 读取：{inp}")
-    vol_hu, affine = load_any(inp)            # [Z,H,W] float32
+    vol_hu, affine = load_any(inp, compact=compact)   # [Z,H,W] float32（compact 时 int16）
     Z,H,W = vol_hu.shape
     vox_mm3 = voxel_volume_mm3(affine)
-    log(f"体素体积(mm^3) ≈ {vox_mm3:.6f}  体积形状：[Z,H,W]={vol_hu.shape}")
+    log(f"体素体积(mm^3) ≈ {vox_mm3:.6f}  体积形状：[Z,H,W]={vol_hu.shape}  dtype={vol_hu.dtype}")
+    peak_load = _peak()
 
     # 2) “银标准”掩膜
     log(f"[2] 筛选（soft={args.soft_lo}~{args.soft_hi} HU, top={args.top_percent*100:.0f}%）")
-    mask, thr = silver_mask(
+    mask, thr, lab, n_lesions = silver_mask(
         vol_hu,
         soft_hu=(args.soft_lo, args.soft_hi),
         top_percent=float(args.top_percent),
         z_smooth_k=int(args.z_smooth),
         min_area=int(args.min_area),
-    )  # uint8
+        compact=compact,
+        return_labels=True,
+    )  # uint8（compact 时 bool）
 
     voxels_raw  = int(mask.sum())
-    vol01       = normalize_to_01(vol_hu, (args.hu_lo, args.hu_hi))
-    mask01      = (mask > 0).astype(np.uint8)
-
-    # 3) 保存 NIfTI（影像 & 掩膜）
-    log("[3] 保存 NIfTI")
-    img_nii  = nib.Nifti1Image(vol_hu, affine if affine is not None else np.eye(4, dtype=np.float32))
-    mask_nii = nib.Nifti1Image(mask01.astype(np.uint8), img_nii.affine)
-    img_path  = outd / f"{prefix}_image.nii.gz"
-    mask_path = outd / f"{prefix}_image_mask.nii.gz"
-    nib.save(img_nii,  str(img_path))
-    nib.save(mask_nii, str(mask_path))
-
-    # 4) 保存叠图（中间层）
-    ov_png = outd / f"{prefix}_overlay_z50.png"
-    save_overlay_mid(vol01, mask01, ov_png)
-
-    # 5) 统计与体积
-    volume_mm3 = vox_mm3 * float(mask01.sum())
+    # 不做整卷归一化：叠图只对要画的那一层做窗宽，预览按批处理
+    mask01 = mask
+
+    # 2b) 病灶级指标（复用连通域步骤的标签卷，一遍算完）
+    lesions = lesion_metrics(lab, n_lesions, vol_hu, affine, vox_mm3, top=int(args.max_lesions))
+    del lab
+    log(f"连通域（病灶）数：{n_lesions}")
+    peak_seg = _peak()
+
+    # 3) 统计与体积
+    volume_mm3 = vox_mm3 * float(voxels_raw)
     volume_ml  = volume_mm3 / 1000.0
 
-    # 6) 专业版报告（沿用你原先口径，单位与字段更清楚）
-    pro_txt = outd / f"{prefix}_report_pro.txt"
-    with open(pro_txt, "w", encoding="utf-8") as f:
-        f.write(
+    peak_total = _peak()
+    if own_trace:
+        tracemalloc.stop()
+    # load/segment 为截至该阶段的峰值；total 为写 JSON 前的峰值（产物在后台导出，不计入）
+    peak_mb = None
+    if trace:
+        peak_mb = {k: round(v / 2**20, 1) for k, v in
+                   (("load", peak_load), ("segment", peak_seg), ("total", peak_total))}
+        log(f"峰值内存（{'compact' if compact else 'float'}）：读取 {peak_mb['load']} MB，"
+            f"筛选 {peak_mb['segment']} MB，全流程 {peak_mb['total']} MB")
+
+    # 按输出档位决定产物（JSON 总是生成）
+    img_path  = outd / f"{prefix}_image.nii.gz"       if "image"       in wanted else None
+    mask_path = outd / f"{prefix}_image_mask.nii.gz"  if "mask"        in wanted else None
+    ov_png    = outd / f"{prefix}_overlay_z50.png"    if "overlay"     in wanted else None
+    pro_txt   = outd / f"{prefix}_report_pro.txt"     if "report_pro"  in wanted else None
+    easy_txt  = outd / f"{prefix}_report_easy.txt"    if "report_easy" in wanted else None
+    preview_idx = outd / f"{prefix}_preview.json"     if "preview"     in wanted else None
+
+    def _name(p: Path | None) -> str:
+        return p.name if p is not None else "（未生成）"
+
+    # 4) 风险评级 & 大小类比
+    level, risk_pct = risk_str(volume_ml, voxels_raw)
+    tag, d_cm, r_cm = size_analogy(volume_ml)
+    largest = lesions[0] if lesions else None
+    if largest is not None:
+        l_tag, l_d_cm, _ = size_analogy(largest["volume_ml"])
+        largest_line = f"最大单个区域：约 {largest['volume_ml']:.1f} ml，直径约 {l_d_cm:.1f} cm（{l_tag}），共 {n_lesions} 处\n"
+    else:
+        largest_line = ""
+
+    # 5) JSON（便于前端或二次开发）——先同步落盘，病例即视为完成
+    rep_json = {
+        "input": str(inp),
+        "output_dir": str(outd),
+        "shape": [int(Z), int(H), int(W)],
+        "voxel_volume_mm3": float(vox_mm3),
+        "soft_mask_hu": [float(args.soft_lo), float(args.soft_hi)],
+        "top_percent": float(args.top_percent),
+        "min_area": int(args.min_area),
+        "threshold_in_soft": float(thr),
+        "voxels_raw": int(voxels_raw),
+        "volume_mm3": float(volume_mm3),
+        "volume_ml": float(volume_ml),
+        "risk_level": level,
+        "risk_pct": float(risk_pct),
+        "size_tag": tag,
+        "equiv_diameter_cm": float(d_cm),
+        "equiv_radius_cm": float(r_cm),
+        "lesion_count": int(n_lesions),
+        "lesions": lesions,
+        "image": img_path.name if img_path else None,
+        "mask": mask_path.name if mask_path else None,
+        "overlay": ov_png.name if ov_png else None,
+        "report_pro": pro_txt.name if pro_txt else None,
+        "report_easy": easy_txt.name if easy_txt else None,
+        "preview": preview_idx.name if preview_idx else None,
+        "profile": profile,
+        "created_at": stamp,
+        "dtype_mode": "compact" if compact else "float",
+        "peak_mem_mb": peak_mb,
+    }
+    json_path = outd / f"{prefix}_report.json"
+    write_json_durable(json_path, rep_json)
+    log(f"✅ 完成：{prefix}（profile={profile}）")
+    log(f" - JSON：   {json_path.name}")
+
+    # 6) 其余产物交给后台导出线程并发写
+    own_exporter = exporter is None
+    if own_exporter:
+        exporter = AsyncExporter()
+
+    if img_path is not None:
+        img_nii = nib.Nifti1Image(vol_hu, affine if affine is not None else np.eye(4, dtype=np.float32))
+        exporter.submit(img_path.name, nib.save, img_nii, str(img_path))
+    if mask_path is not None:
+        exporter.submit(mask_path.name, lambda: nib.save(
+            nib.Nifti1Image(mask01.astype(np.uint8),
+                            affine if affine is not None else np.eye(4, dtype=np.float32)),
+            str(mask_path)))
+    if ov_png is not None:
+        exporter.submit(ov_png.name, save_overlay_mid, vol_hu, mask01, ov_png,
+                        win=(args.hu_lo, args.hu_hi))
+    if preview_idx is not None:
+        exporter.submit(preview_idx.name, build_preview, vol_hu, mask01, outd, prefix,
+                        win=(args.hu_lo, args.hu_hi),
+                        step=int(getattr(args, "preview_step", DEF_PREVIEW_STEP)),
+                        size=int(getattr(args, "preview_size", DEF_PREVIEW_SIZE)),
+                        sprite=bool(getattr(args, "preview_sprite", False)))
+
+    # 专业版报告（沿用你原先口径，单位与字段更清楚）
+    if pro_txt is not None:
+        exporter.submit(pro_txt.name, write_text, pro_txt,
             "【Banana 专业报告】\n"
             f"输入：{str(inp)}\n"
             f"输出目录：{str(outd)}\n"
@@ -280,57 +618,39 @@ def main():
             f"掩膜体素（raw）：{voxels_raw}\n"
             f"病灶体积(mm^3)：{volume_mm3:.3f}\n"
             f"病灶体积(ml)：{volume_ml:.3f}\n"
-            f"影像：{img_path.name}\n"
-            f"掩膜：{mask_path.name}\n"
-            f"叠图：{ov_png.name}\n"
+            f"病灶（连通域）数：{n_lesions}\n"
+            + "".join(
+                f"  #{d['rank']} 体积 {d['volume_ml']:.3f} ml，等效直径 {d['equiv_diameter_mm']:.1f} mm，"
+                f"质心(mm) {d['centroid_mm']}，HU 均值/最大 {d['hu_mean']:.1f}/{d['hu_max']:.1f}\n"
+                for d in lesions[:5]
+            ) +
+            f"影像：{_name(img_path)}\n"
+            f"掩膜：{_name(mask_path)}\n"
+            f"叠图：{_name(ov_png)}\n"
         )
 
-    # 7) 大众版结论
-    level, risk_pct = risk_str(volume_ml, voxels_raw)
-    tag, d_cm, r_cm = size_analogy(volume_ml)
-    easy_txt = outd / f"{prefix}_report_easy.txt"
-    with open(easy_txt, "w", encoding="utf-8") as f:
-        f.write(
+    # 大众版结论
+    if easy_txt is not None:
+        exporter.submit(easy_txt.name, write_text, easy_txt,
             "【Banana 大众版结论（演示用，非最终医疗诊断）】\n"
             f"疑似风险：{level}（约 {risk_pct:.0f}%）\n"
             f"疑似区域总体积：约 {volume_ml:.1f} ml\n"
             f"等体积球体直径：约 {d_cm:.1f} cm（{tag}）\n"
+            f"{largest_line}"
             f"下一步建议：{easy_recommendation(level)}\n"
             "\n"
             "温馨提示：本工具为科研原型，结论仅供参考，请结合增强影像、临床表现与专科医生意见。\n"
         )
 
-    # 8) JSON（便于前端或二次开发）
-    rep_json = {
-        "input": str(inp),
-        "output_dir": str(outd),
-        "shape": [int(Z), int(H), int(W)],
-        "voxel_volume_mm3": float(vox_mm3),
-        "soft_mask_hu": [float(args.soft_lo), float(args.soft_hi)],
-        "top_percent": float(args.top_percent),
-        "min_area": int(args.min_area),
-        "threshold_in_soft": float(thr),
-        "voxels_raw": int(voxels_raw),
-        "volume_mm3": float(volume_mm3),
-        "volume_ml": float(volume_ml),
-        "risk_level": level,
-        "risk_pct": float(risk_pct),
-        "size_tag": tag,
-        "equiv_diameter_cm": float(d_cm),
-        "equiv_radius_cm": float(r_cm),
-        "image": img_path.name,
-        "mask": mask_path.name,
-        "overlay": ov_png.name,
-        "created_at": stamp,
-    }
-    with open(outd / f"{prefix}_report.json", "w", encoding="utf-8") as f:
-        json.dump(rep_json, f, ensure_ascii=False, indent=2)
-
-    log(f"✅ 完成：{prefix}")
-    log(f" - 专业版：{pro_txt.name}")
-    log(f" - 大众版：{easy_txt.name}")
-    log(f" - JSON：   {prefix}_report.json")
+    if pro_txt is not None:
+        log(f" - 专业版：{pro_txt.name}")
+    if easy_txt is not None:
+        log(f" - 大众版：{easy_txt.name}")
     log("（声明：以上为原型演示结果，非医学诊断）")
 
+    if own_exporter:
+        report_export_failures(exporter.close())
+    return json_path
+
 if __name__ == "__main__":
     main()
@@ -7,46 +7,69 @@
 输出：*_report.pdf 写回到 outputs/
 """
 from __future__ import annotations
-import re, json, sys
+import os, io, re, json, math, sys
 from pathlib import Path
 from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from fpdf import FPDF
+from fpdf.enums import TextMode
 from PIL import Image
 
+def prefix_of(p: Path) -> str:
+    """
+    由产物文件名取“前缀”。
+    例如：case_20250821_095616_xxx => 前缀是 case_20250821_095616
+    """
+    m = re.match(r"(.+?)_(image|image_mask|overlay_z\d+|report|report\.json)", p.stem)
+    return m.group(1) if m else p.stem
+
+def _list_outputs(out_dir: Path) -> list[Path]:
+    out_dir = Path(out_dir)
+    return sorted(out_dir.glob("*_report.txt")) + sorted(out_dir.glob("*_report.json")) + sorted(out_dir.glob("*_overlay_z*.png"))
+
+def group_of(out_dir: Path, prefix: str) -> dict:
+    """按前缀收集一组产物。"""
+    out_dir = Path(out_dir)
+    return {
+        "prefix": prefix,
+        "easy_txt": next(iter(sorted(out_dir.glob(f"{prefix}_report_easy.txt"))), None),
+        "full_txt": next(iter(sorted(out_dir.glob(f"{prefix}_report.txt"))), None),
+        "json":     next(iter(sorted(out_dir.glob(f"{prefix}_report.json"))), None),
+        "overlay_pngs": sorted(out_dir.glob(f"{prefix}_overlay_z*.png")),
+        "png_any":  sorted(out_dir.glob(f"{prefix}_*.png")),   # 只在本病例的产物里兜底
+    }
+
 def find_latest_group(out_dir: Path) -> dict:
     """
     在 out_dir 找一组同名前缀的产物，按时间最新的那组。
     返回 dict: {prefix, easy_txt, full_txt, json, overlay_pngs, png_any}
     """
     out_dir = Path(out_dir)
-    items = sorted(out_dir.glob("*_report.txt")) + sorted(out_dir.glob("*_report.json")) + sorted(out_dir.glob("*_overlay_z*.png"))
+    items = _list_outputs(out_dir)
     if not items:
         raise FileNotFoundError(f"在 {out_dir} 未找到任何可用输出。")
 
-    # 取最后修改时间最新的“前缀”
-    # 例如：case_20250821_095616_xxx => 前缀是 case_20250821_095616
-    def prefix_of(p: Path) -> str:
-        m = re.match(r"(.+?)_(image|image_mask|overlay_z\d+|report|report\.json)", p.stem)
-        return m.group(1) if m else p.stem
-
     # 找到最新文件的前缀
     newest = max(items, key=lambda p: p.stat().st_mtime)
-    prefix = prefix_of(newest)
+    return group_of(out_dir, prefix_of(newest))
 
-    group = {
-        "prefix": prefix,
-        "easy_txt": next(iter(sorted(out_dir.glob(f"{prefix}_report_easy.txt"))), None),
-        "full_txt": next(iter(sorted(out_dir.glob(f"{prefix}_report.txt"))), None),
-        "json":     next(iter(sorted(out_dir.glob(f"{prefix}_report.json"))), None),
-        "overlay_pngs": sorted(out_dir.glob(f"{prefix}_overlay_z*.png")),
-        "png_any":  sorted(out_dir.glob("*.png")),
-    }
-    return group
+def find_all_groups(out_dir: Path) -> list[dict]:
+    """
+    在 out_dir 找出所有前缀的产物组（批量模式用），按前缀排序。
+    """
+    out_dir = Path(out_dir)
+    items = _list_outputs(out_dir)
+    if not items:
+        raise FileNotFoundError(f"在 {out_dir} 未找到任何可用输出。")
+    prefixes = sorted({prefix_of(p) for p in items})
+    return [group_of(out_dir, pf) for pf in prefixes]
 
-def read_summary(group: dict) -> str:
+def read_summary(group: dict, data: dict | None = None) -> str:
     """
     读取大众版或专业版文本；若两者都没有，再从 json 提炼关键信息。
+    data 为已解析好的 JSON（load_case 传入，避免重复解析）；不传时才自己读。
     返回纯文本（会被打印在 PDF 里）
     """
     if group["easy_txt"] and group["easy_txt"].exists():
@@ -55,8 +78,9 @@ def read_summary(group: dict) -> str:
     if group["full_txt"] and group["full_txt"].exists():
         return group["full_txt"].read_text(encoding="utf-8", errors="ignore")
 
-    if group["json"] and group["json"].exists():
-        data = json.loads(group["json"].read_text(encoding="utf-8", errors="ignore"))
+    if data is None:
+        data = read_json(group)
+    if data is not None:
         # 简单拼一个摘要
         lines = []
         lines.append("【Banana 自动分析摘要】")
@@ -78,7 +102,7 @@ def read_summary(group: dict) -> str:
 
 def choose_image(group: dict) -> Path | None:
     """
-    选择一张要放进 PDF 的图片：优先 overlay，找不到就随便挑一张 png。
+    选择一张要放进 PDF 的图片：优先 overlay，找不到就用本病例的其它 png。
     """
     if group["overlay_pngs"]:
         return group["overlay_pngs"][0]
@@ -86,97 +110,351 @@ def choose_image(group: dict) -> Path | None:
         return group["png_any"][0]
     return None
 
+# ------------ 字体（中文需要 Unicode TTF；每个 FPDF 注册一次，整份文档复用） ------------
+FONT_ENV    = "BANANA_PDF_FONT"       # 也可用 --font 指定
+FONT_FAMILY = "BananaCJK"
+FONT_CANDIDATES = (
+    # Windows
+    "C:/Windows/Fonts/simhei.ttf", "C:/Windows/Fonts/Deng.ttf",
+    "C:/Windows/Fonts/msyh.ttc", "C:/Windows/Fonts/simsun.ttc",
+    # macOS
+    "/System/Library/Fonts/STHeiti Medium.ttc", "/System/Library/Fonts/PingFang.ttc",
+    "/Library/Fonts/Arial Unicode.ttf",
+    # Linux
+    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+)
+_FONT_PATH: str | None = None         # 本进程第一次注册成功的字体，后续 FPDF 直接用它
+_FONT_WARNED = False
+
+def _register_font(pdf: FPDF) -> str:
+    """给 pdf 注册 Unicode 字体，返回字体族名；一个都不可用时退回 Helvetica。"""
+    global _FONT_PATH, _FONT_WARNED
+    env = os.environ.get(FONT_ENV)
+    cands = [_FONT_PATH] if _FONT_PATH else [c for c in ([env] if env else []) + list(FONT_CANDIDATES)]
+    for c in cands:
+        if not c or not Path(c).is_file():
+            continue
+        try:
+            # 只注册常规字形：中文字体一般没有粗体，粗体由 set_font 描边模拟，
+            # 每份文档只解析一次字体文件
+            pdf.add_font(FONT_FAMILY, "", c)
+        except Exception:
+            continue
+        _FONT_PATH = c
+        return FONT_FAMILY
+    if not _FONT_WARNED:
+        _FONT_WARNED = True
+        print(f"[!] 未找到可用的中文字体（可用 --font 或环境变量 {FONT_ENV} 指定 .ttf），非拉丁字符将显示为 ?")
+    return "Helvetica"
+
+BOLD_STROKE = 0.03                    # 模拟粗体的描边宽度（相对字号）
+
+def set_font(pdf: FPDF, size: float = 11):
+    pdf.set_font(pdf.banana_font, "", size)
+
+@contextmanager
+def bold(pdf: FPDF, size: float):
+    """
+    粗体段落：只注册了常规字形，用“填充+描边”模拟。
+    描边模式属于图形状态，放在 local_context（q/Q）里，退出后不会带到后面的正文。
+    """
+    if pdf.banana_font != FONT_FAMILY:
+        pdf.set_font(pdf.banana_font, "B", size)
+        yield
+        return
+    with pdf.local_context(text_mode=TextMode.FILL_STROKE,
+                           line_width=size * BOLD_STROKE * 25.4 / 72):   # 字号 pt → 线宽 mm
+        pdf.set_font(FONT_FAMILY, "", size)
+        yield
+
+def txt(pdf: FPDF, s: str) -> str:
+    """退回 Helvetica 时把核心字体编码不了的字符换成 ?，避免 fpdf 抛异常。"""
+    if pdf.banana_font == FONT_FAMILY:
+        return s
+    return s.encode("latin-1", "replace").decode("latin-1")
+
 def add_footer(pdf: FPDF, text: str):
     pdf.set_y(-15)
-    pdf.set_font("Helvetica", size=9)
+    set_font(pdf, 9)
     pdf.set_text_color(150,150,150)
-    pdf.cell(0, 10, text, 0, 0, "R")
+    pdf.cell(0, 10, txt(pdf, text), 0, 0, "R")
 
 def mm(v: float) -> float:
     return float(v)
 
-def build_pdf(out_dir: Path) -> Path:
-    group = find_latest_group(out_dir)
-    summary = read_summary(group)
-    img_path = choose_image(group)
-
-    # 输出文件名
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    pdf_path = Path(out_dir) / f"{group['prefix']}_report.pdf"
+# ------------ 版式（只算一次，单份/批量/合集 PDF 共用） ------------
+PAGE_LEFT, PAGE_TOP, PAGE_RIGHT = mm(15), mm(25), mm(195)
+TEXT_W    = mm(90)                    # 左边放文字 90mm
+IMG_X     = PAGE_LEFT + TEXT_W + mm(5)  # 右边图片与文字间隔 5mm
+IMG_W     = PAGE_RIGHT - IMG_X        # 右侧能用的宽度
+IMG_MAX_H = mm(150)                   # 图高不超过 150mm
+IMG_DPI   = 180                       # 嵌入图片按实际显示尺寸取这个分辨率（85mm 宽 ≈ 600 px）
+CACHE_DIRNAME = ".pdf_cache"          # 缩放后图片的缓存目录（位于 out_dir 下）
 
+def new_pdf() -> FPDF:
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     pdf.set_auto_page_break(auto=False, margin=mm(15))
+    pdf.banana_font = _register_font(pdf)
+    return pdf
+
+def fit_image(w: int, h: int) -> tuple[float, float]:
+    """等比例缩放到右侧图片区域，返回 (显示宽, 显示高) mm。"""
+    # 根据目标宽度 IMG_W 先算缩放后的高度
+    scale_h = h * (IMG_W / w)
+    if scale_h > IMG_MAX_H:
+        # 超高则以高度限制，再反算宽度
+        return w * (IMG_MAX_H / h), IMG_MAX_H
+    return IMG_W, scale_h
+
+def prepare_image(img_path: Path, cache_dir: Path, dpi: int = IMG_DPI) -> tuple[Path, int, int]:
+    """
+    按 PDF 中的显示尺寸（fit_image）和 dpi 算出需要的像素，返回 (要嵌入的图片, 宽, 高)。
+    - 源图不超过需要的像素：直接用源图，不重新编码
+    - 否则缩放并转 JPEG 缓存；若结果并不比源图小，仍用源图
+    缓存键包含源文件的 mtime/大小，源图更新后会自动重新判断；
+    宽高写在缓存文件名里（.src 表示“用源图”），命中缓存时不再用 Pillow 打开图片。
+    """
+    img_path = Path(img_path)
+    st = img_path.stat()
+    key = f"{img_path.stem}_{st.st_mtime_ns:x}_{st.st_size:x}_{int(dpi)}"
+    for hit in Path(cache_dir).glob(f"{key}_*x*.*"):
+        m = re.search(r"_(\d+)x(\d+)$", hit.stem)
+        if m:
+            return (img_path if hit.suffix == ".src" else hit), int(m.group(1)), int(m.group(2))
+
+    with Image.open(img_path) as im:
+        w, h = im.size
+        disp_w, disp_h = fit_image(w, h)
+        max_w = math.ceil(disp_w / 25.4 * dpi)
+        max_h = math.ceil(disp_h / 25.4 * dpi)
+        if w <= max_w and h <= max_h:
+            return img_path, w, h
+        im = im.convert("RGB")
+        im.thumbnail((max_w, max_h), Image.LANCZOS)
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=85, optimize=True)
+        tw, th = im.size
+
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    if buf.tell() >= st.st_size:
+        # 缩放后的 JPEG 反而更大（线条图、大片纯色常见）：记下结论，继续用源图
+        (Path(cache_dir) / f"{key}_{w}x{h}.src").touch()
+        return img_path, w, h
+    out = Path(cache_dir) / f"{key}_{tw}x{th}.jpg"
+    tmp = out.with_suffix(".tmp")
+    tmp.write_bytes(buf.getvalue())
+    # 先写临时文件再改名，避免并发进程读到半截缓存
+    tmp.replace(out)
+    return out, tw, th
+
+def read_json(group: dict) -> dict | None:
+    if group["json"] and group["json"].exists():
+        try:
+            return json.loads(group["json"].read_text(encoding="utf-8", errors="ignore"))
+        except Exception:
+            return None
+    return None
+
+def load_case(group: dict, cache_dir: Path) -> dict:
+    """
+    一次性读取一组产物需要的全部内容（文本、JSON、缩放后的图片），
+    之后渲染单份 PDF 和合集 PDF 都只用这里的结果，不再重复打开源文件。
+    """
+    data = read_json(group)
+    case = {
+        "prefix": group["prefix"],
+        "summary": read_summary(group, data),
+        "data": data,
+        "image": None,        # (缓存路径, 宽, 高)
+        "image_name": None,
+        "image_error": None,
+    }
+    img_path = choose_image(group)
+    if img_path and img_path.exists():
+        case["image_name"] = img_path.name
+        try:
+            case["image"] = prepare_image(img_path, cache_dir)
+        except Exception as e:
+            case["image_error"] = str(e)
+    return case
 
-    # ============ 第 1 页：文字 + 大图在同一页 ============
+def render_case_page(pdf: FPDF, case: dict):
+    """文字 + 大图在同一页。"""
     pdf.add_page()
 
     # 标题
-    pdf.set_font("Helvetica", "B", 18)
     pdf.set_text_color(0,0,0)
-    pdf.cell(0, 12, "Banana 自動分析報告 (演示用)", 0, 1, "L")
-
-    # 左侧文字框
-    left_x, top_y, right_x = mm(15), mm(25), mm(195)
-    text_w = mm(90)  # 左边放文字 90mm
-    img_x = left_x + text_w + mm(5)  # 右边图片与文字间隔 5mm
-    img_w = right_x - img_x  # 右侧能用的宽度
+    with bold(pdf, 18):
+        pdf.cell(0, 12, txt(pdf, "Banana 自動分析報告 (演示用)"), 0, 1, "L")
 
-    # 文字
-    pdf.set_font("Helvetica", size=11)
-    pdf.set_xy(left_x, top_y)
+    # 左侧文字
+    set_font(pdf, 11)
+    pdf.set_xy(PAGE_LEFT, PAGE_TOP)
     # 将多行文本分段输出，避免一次性 cell 太长
-    for para in summary.splitlines():
+    for para in case["summary"].splitlines():
         if not para.strip():
             pdf.ln(4)
             continue
-        pdf.multi_cell(text_w, 6, para, 0, "L")
+        pdf.multi_cell(TEXT_W, 6, txt(pdf, para), 0, "L")
 
-    # 右侧放图（等比例缩放）
-    if img_path and img_path.exists():
-        try:
-            with Image.open(img_path) as im:
-                w, h = im.size
-            # 计算等比缩放，图高不超过 150mm
-            max_h = mm(150)
-            # 根据目标宽度 img_w 先算缩放后的高度
-            scale_h = h * (img_w / w)
-            if scale_h > max_h:
-                # 超高则以高度限制，再反算宽度
-                disp_h = max_h
-                disp_w = w * (disp_h / h)
-            else:
-                disp_w = img_w
-                disp_h = scale_h
-            # 垂直位置：与文字顶部对齐
-            pdf.image(str(img_path), x=img_x, y=top_y, w=disp_w, h=disp_h)
-        except Exception as e:
-            pdf.set_xy(img_x, top_y)
-            pdf.set_text_color(180,0,0)
-            pdf.multi_cell(img_w, 6, f"加载图片失败：{img_path.name}\n{e}", 0, "L")
+    # 右侧放图（等比例缩放），垂直位置与文字顶部对齐
+    if case["image"] is not None:
+        path, w, h = case["image"]
+        disp_w, disp_h = fit_image(w, h)
+        pdf.image(str(path), x=IMG_X, y=PAGE_TOP, w=disp_w, h=disp_h)
+    elif case["image_error"] is not None:
+        pdf.set_xy(IMG_X, PAGE_TOP)
+        pdf.set_text_color(180,0,0)
+        pdf.multi_cell(IMG_W, 6, txt(pdf, f"加载图片失败：{case['image_name']}\n{case['image_error']}"), 0, "L")
     else:
-        pdf.set_xy(img_x, top_y)
+        pdf.set_xy(IMG_X, PAGE_TOP)
         pdf.set_text_color(120,120,120)
-        pdf.multi_cell(img_w, 6, "未找到可用的 PNG 图像。", 0, "L")
+        pdf.multi_cell(IMG_W, 6, txt(pdf, "未找到可用的 PNG 图像。"), 0, "L")
 
     # 页脚
-    add_footer(pdf, f"Generated {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}  |  {group['prefix']}")
+    add_footer(pdf, f"Generated {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}  |  {case['prefix']}")
+
+def write_case_pdf(case: dict, out_dir: Path) -> Path:
+    pdf_path = Path(out_dir) / f"{case['prefix']}_report.pdf"
+    pdf = new_pdf()
+    render_case_page(pdf, case)
+    pdf.output(str(pdf_path))
+    return pdf_path
+
+def build_pdf(out_dir: Path) -> Path:
+    group = find_latest_group(out_dir)
+    case = load_case(group, Path(out_dir) / CACHE_DIRNAME)
+    return write_case_pdf(case, out_dir)
+
+# ------------ 批量模式 ------------
+def _batch_one(out_dir: Path, prefix: str) -> dict:
+    """
+    进程池任务：生成单个病例的 PDF，并把读到的内容带回主进程供合集复用。
+    出错只记在该病例的 "error" 里，不影响其它病例。
+    """
+    try:
+        case = load_case(group_of(out_dir, prefix), Path(out_dir) / CACHE_DIRNAME)
+        case["pdf"] = write_case_pdf(case, out_dir)
+        case["error"] = None
+    except Exception as e:
+        case = {"prefix": prefix, "pdf": None, "error": f"{type(e).__name__}: {e}"}
+    return case
+
+def _fmt(v, nd: int = 1) -> str:
+    if v is None:
+        return "-"
+    return f"{v:.{nd}f}" if isinstance(v, float) else str(v)
+
+def render_cohort_table(pdf: FPDF, cases: list[dict]):
+    """合集首页：每个病例一行的汇总表，超出一页自动续页。"""
+    cols = [("#", 10), ("Case", 80), ("Volume(ml)", 25), ("Risk", 20), ("Thr(HU)", 20), ("Voxels", 25)]
+
+    def header():
+        pdf.add_page()
+        pdf.set_text_color(0,0,0)
+        with bold(pdf, 16):
+            pdf.cell(0, 12, f"Banana Cohort Summary  ({len(cases)} cases)", 0, 1, "L")
+        with bold(pdf, 9):
+            for name, w in cols:
+                pdf.cell(w, 7, name, 1, 0, "C")
+        pdf.ln(7)
+        set_font(pdf, 9)
+
+    header()
+    for i, case in enumerate(cases, 1):
+        if pdf.get_y() > 270:
+            header()
+        d = case["data"] or {}
+        row = [str(i), case["prefix"],
+               _fmt(d.get("volume_ml")), _fmt(d.get("risk_level")),
+               _fmt(d.get("threshold_in_soft")), _fmt(d.get("voxels_raw"))]
+        for (_, w), cell in zip(cols, row):
+            pdf.cell(w, 6, txt(pdf, cell), 1, 0, "L")
+        pdf.ln(6)
+    add_footer(pdf, f"Generated {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}  |  cohort")
 
-    # 保存
+def build_cohort_pdf(cases: list[dict], out_dir: Path) -> Path:
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    pdf_path = Path(out_dir) / f"cohort_{ts}.pdf"
+    pdf = new_pdf()
+    render_cohort_table(pdf, cases)
+    for case in cases:
+        render_case_page(pdf, case)
     pdf.output(str(pdf_path))
     return pdf_path
 
+def build_pdf_batch(out_dir: Path, workers: int = 0, cohort: bool = False
+                    ) -> tuple[list[Path], Path | None, list[tuple[str, str]]]:
+    """
+    为 out_dir 里的每个病例各生成一份 PDF（进程池并行），可选再生成一份合集 PDF。
+    workers<=0 时按 CPU 数；workers==1 时串行。
+    单个病例失败（含工作进程崩溃）不会中断整批，合集只收成功的病例。
+    返回：(各病例 PDF 路径列表, 合集 PDF 路径或 None, 失败列表 [(前缀, 原因)])
+    """
+    out_dir = Path(out_dir)
+    prefixes = [g["prefix"] for g in find_all_groups(out_dir)]
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(prefixes))
+
+    if workers <= 1:
+        cases = [_batch_one(out_dir, pf) for pf in prefixes]
+    else:
+        by_prefix = {}
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futs = {ex.submit(_batch_one, out_dir, pf): pf for pf in prefixes}
+            for fut in as_completed(futs):
+                pf = futs[fut]
+                try:
+                    by_prefix[pf] = fut.result()
+                except Exception as e:       # 例如工作进程被杀（BrokenProcessPool）
+                    by_prefix[pf] = {"prefix": pf, "pdf": None, "error": f"{type(e).__name__}: {e}"}
+        cases = [by_prefix[pf] for pf in prefixes]
+
+    ok = [c for c in cases if c["error"] is None]
+    failed = [(c["prefix"], c["error"]) for c in cases if c["error"] is not None]
+    cohort_path = build_cohort_pdf(ok, out_dir) if cohort and ok else None
+    return [c["pdf"] for c in ok], cohort_path, failed
+
 def main():
     # 命令：python make_pdf.py --in_dir C:\...\outputs
+    # 批量：python make_pdf.py --in_dir C:\...\outputs --all [--workers 4] [--cohort]
+    # 字体：--font C:\Windows\Fonts\simhei.ttf（默认在常见系统字体里自动找）
     # 默认为脚本同目录的 outputs
     in_dir = None
+    workers = 0
     args = sys.argv[1:]
     if "--in_dir" in args:
         i = args.index("--in_dir")
         if i+1 < len(args):
             in_dir = Path(args[i+1])
+    if "--workers" in args:
+        i = args.index("--workers")
+        if i+1 < len(args):
+            workers = int(args[i+1])
+    if "--font" in args:
+        i = args.index("--font")
+        if i+1 < len(args):
+            # 走环境变量，进程池里的子进程也能拿到
+            os.environ[FONT_ENV] = args[i+1]
     if not in_dir:
         in_dir = Path(__file__).resolve().parent / "outputs"
 
+    if "--all" in args or "--cohort" in args:
+        pdfs, cohort, failed = build_pdf_batch(in_dir, workers=workers, cohort="--cohort" in args)
+        print(f"[+] 批量生成 {len(pdfs)} 份 PDF：{in_dir}")
+        if cohort:
+            print(f"[+] 合集 PDF 已生成：{cohort}")
+        for pf, err in failed:
+            print(f"[!] 失败：{pf}  {err}")
+        if failed:
+            sys.exit(1)
+        return
+
     pdfp = build_pdf(in_dir)
     print(f"[+] PDF 已生成：{pdfp}")
 
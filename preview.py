@@ -0,0 +1,97 @@
+from __future__ import annotations
+import math
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+from export import write_json_durable
+
+# ------------ 可选依赖（没有 Pillow 只是不出 PNG 拼图） ------------
+try:
+    from PIL import Image
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+DEF_PREVIEW_SIZE = 256      # 缩略图最长边（像素）
+DEF_PREVIEW_STEP = 1        # 每隔几层取一层
+_CHUNK = 16                 # 每批处理的层数，控制临时内存
+
+def _block_reduce(a: np.ndarray, fy: int, fx: int, how: str) -> np.ndarray:
+    """[N,H,W] 按 fy×fx 块取均值或最大值（末尾不足一块的行列丢弃）"""
+    if fy <= 1 and fx <= 1:
+        return a
+    n, h, w = a.shape
+    a = a[:, :h // fy * fy, :w // fx * fx].reshape(n, h // fy, fy, w // fx, fx)
+    return a.mean(axis=(2, 4)) if how == "mean" else a.max(axis=(2, 4))
+
+def build_preview(vol_hu: np.ndarray, mask: np.ndarray, out_dir: Path, prefix: str, *,
+                  win: Tuple[float, float] = (-200.0, 400.0),
+                  step: int = DEF_PREVIEW_STEP,
+                  size: int = DEF_PREVIEW_SIZE,
+                  alpha: float = 0.35,
+                  sprite: bool = False) -> Path:
+    """
+    生成整例的切片预览：每 step 层一张窗宽后的 RGB uint8 缩略图，掩膜以红色叠加。
+    产物：
+      <prefix>_preview.npy   [N,h,w,3] uint8，可用 np.load(..., mmap_mode="r") 直接按层取
+      <prefix>_preview.json  索引：取样层号、缩放倍数、窗宽、含掩膜的层号等
+      <prefix>_preview.png   （sprite=True 且有 Pillow 时）按网格平铺的拼图
+    按批向量化处理，不回读 NIfTI；返回索引 JSON 路径。
+    """
+    out_dir = Path(out_dir)
+    Z, H, W = vol_hu.shape
+    step = max(1, int(step))
+    zs = np.arange(0, Z, step)
+    f = max(1, math.ceil(max(H, W) / max(1, int(size))))
+    # 每个轴的倍数不超过该轴长度：极扁的切片也至少留 1 行/列，不会得到空的缩略图
+    fy, fx = min(f, max(1, H)), min(f, max(1, W))
+    h, w = max(1, H // fy), max(1, W // fx)
+    lo, hi = win
+
+    # 含掩膜的层：整卷一次算完（不只是取样层）
+    per_slice = np.count_nonzero(mask.reshape(Z, -1), axis=1)
+    mask_slices = np.flatnonzero(per_slice)
+
+    npy_path = out_dir / f"{prefix}_preview.npy"
+    thumbs = np.lib.format.open_memmap(npy_path, mode="w+", dtype=np.uint8, shape=(len(zs), h, w, 3))
+    red = np.array([255.0, 0.0, 0.0], dtype=np.float32)
+    for i in range(0, len(zs), _CHUNK):
+        idx = zs[i:i + _CHUNK]
+        v = np.clip(vol_hu[idx].astype(np.float32), lo, hi)
+        v = (_block_reduce(v, fy, fx, "mean") - lo) * (255.0 / (hi - lo + 1e-6))
+        m = _block_reduce(mask[idx] > 0, fy, fx, "max")
+        rgb = np.repeat(v[..., None], 3, axis=-1)
+        rgb[m] = (1.0 - alpha) * rgb[m] + alpha * red
+        thumbs[i:i + len(idx)] = np.rint(rgb).astype(np.uint8)
+    thumbs.flush()
+
+    index = {
+        "file": npy_path.name,
+        "shape": [int(len(zs)), int(h), int(w), 3],
+        "volume_shape": [int(Z), int(H), int(W)],
+        "step": step,
+        "downsample": [fy, fx],
+        "window_hu": [float(lo), float(hi)],
+        "slices": zs.tolist(),
+        "mask_slices": mask_slices.tolist(),
+        "mask_voxels_per_slice": per_slice.tolist(),
+        "sprite": None,
+    }
+
+    if sprite and _HAS_PIL and len(zs):
+        cols = math.ceil(math.sqrt(len(zs)))
+        rows = math.ceil(len(zs) / cols)
+        tiles = np.zeros((rows * cols, h, w, 3), dtype=np.uint8)
+        tiles[:len(zs)] = thumbs
+        grid = tiles.reshape(rows, cols, h, w, 3).transpose(0, 2, 1, 3, 4).reshape(rows * h, cols * w, 3)
+        sprite_path = out_dir / f"{prefix}_preview.png"
+        Image.fromarray(grid).save(sprite_path, optimize=True)
+        index["sprite"] = {"file": sprite_path.name, "cols": cols, "rows": rows, "tile": [h, w]}
+
+    del thumbs
+    # _report.json 里已写了索引名，前端可能在轮询：原子落盘，不会读到半截
+    idx_path = out_dir / f"{prefix}_preview.json"
+    write_json_durable(idx_path, index)
+    return idx_path
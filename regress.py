@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+r"""
+Banana — 回归 / 等价性检查
+在合成体模（NIfTI 与生成的 DICOM 序列，以及可选的样例数据）上跑各个实现（backend），记录
+  掩膜哈希、体素数、阈值、耗时，并与保存的参考结果比 Dice，
+病灶指标（lesion_metrics）与逐组件的朴素计算对照。
+最后输出一张“速度 + 等价性”对照表。性能优化合并前跑一遍即可。
+
+用法：
+  python regress.py                       # 与 regress_refs/ 中的参考比对
+  python regress.py --update              # 用参考实现（serial）重新生成参考
+  python regress.py --sample "<nii/zip/DICOM文件夹>"   # 额外加入样例数据
+
+没有保存参考的条目（样例数据、--update 时）各实现与本次 serial 的结果比对。
+
+退出码：有不一致（DIFF）时为 1。
+"""
+from __future__ import annotations
+import sys, json, time, hashlib, argparse, tempfile
+from pathlib import Path
+from typing import Callable, Dict
+
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+try:
+    from scipy import ndimage as ndi
+except ImportError:
+    # 流水线里 SciPy 是可选的，但参考实现（逐组件朴素计算）离不开它
+    sys.exit("regress.py 需要 SciPy：pip install \"scipy>=1.14.1\"")
+
+import main as pipeline
+import io_dicom
+from silver_filter import silver_infer, clean_small_objects_3d
+from utils import INT16_MIN, INT16_MAX, to_int16_if_lossless
+
+DEF_REF_DIR = Path(__file__).resolve().parent / "regress_refs"
+REF_BACKEND = "serial"             # 参考实现：每个目标都有，--update 时用它生成参考
+THR_ATOL    = 1e-4                 # 阈值允许的浮点误差
+MM_ATOL     = 6e-3                 # centroid_mm 输出保留两位小数
+
+# ------------ 合成体模（固定种子，可复现） ------------
+def _ellipsoid(shape, center, radii) -> np.ndarray:
+    zz, yy, xx = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    return (((zz - center[0]) / radii[0]) ** 2 +
+            ((yy - center[1]) / radii[1]) ** 2 +
+            ((xx - center[2]) / radii[2]) ** 2) <= 1.0
+
+def make_phantom(name: str) -> tuple[np.ndarray, np.ndarray]:
+    """返回 (HU 体积 int16 [Z,H,W], affine)；affine 作用在 [Z,H,W] 下标上，三个轴间距各不相同"""
+    shape = (24, 96, 96)
+    rng = np.random.default_rng({"single": 1, "multi": 2, "noise": 3}[name])
+    vol = np.full(shape, -1000.0)                                   # 空气
+    vol[_ellipsoid(shape, (12, 48, 48), (14, 40, 44))] = 40.0       # 软组织“腹部”
+    if name == "single":
+        vol[_ellipsoid(shape, (12, 40, 55), (5, 10, 12))] = 150.0
+    elif name == "multi":
+        for c, r, hu in [((8, 30, 30), (3, 6, 6), 160.0), ((15, 60, 50), (4, 9, 8), 130.0),
+                         ((12, 45, 70), (2, 4, 4), 180.0), ((18, 35, 60), (2, 3, 3), 170.0)]:
+            vol[_ellipsoid(shape, c, r)] = hu
+    vol += rng.normal(0.0, 25.0 if name != "noise" else 90.0, shape)
+    affine = np.diag([2.5, 0.8, 0.7, 1.0])
+    affine[:3, 3] = (-30.0, 12.0, 5.0)
+    return np.rint(vol).astype(np.int16), affine
+
+PHANTOMS = ("single", "multi", "noise")
+
+# DICOM 体模：(名称, 体模, RescaleSlope, RescaleIntercept)。
+# 整数 slope 时紧凑读取应保持 int16；0.5 时 HU 带半整数，必须退回 float32
+DICOM_PHANTOMS = (("dcm_int", "multi", 1.0, -1024.0), ("dcm_half", "multi", 0.5, -1024.0))
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+# 带缩放的 NIfTI 体模：(名称, 体模, scl_slope, scl_inter)，int16 存储值 + 头里的缩放，
+# 与常见 CT 转换结果一致；紧凑读取应得到 int16，默认读取为 float32
+NII_SCALED_PHANTOMS = (("nii_scl", "multi", 1.0, -1024.0),)
+
+def write_dicom_series(vol_hu: np.ndarray, affine: np.ndarray, folder: Path,
+                       slope: float, inter: float, seed: str):
+    """
+    把 [Z,H,W] 的 HU 体积写成一套单帧 CT 序列（int16 存储值 + Rescale），
+    几何按 affine（对角、作用在 [Z,H,W] 下标上）：层间距 → SliceThickness / IPP，行列间距 → PixelSpacing。
+    UID 由 seed 派生，结果可复现。
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    stored = np.rint((vol_hu - inter) / slope).astype(np.int16)
+    sz, sy, sx = (float(affine[a, a]) for a in range(3))
+    oz, oy, ox = (float(v) for v in affine[:3, 3])
+    study, series, frame = (generate_uid(entropy_srcs=[seed, t]) for t in ("study", "series", "frame"))
+    for k in range(stored.shape[0]):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+        meta.MediaStorageSOPInstanceUID = generate_uid(entropy_srcs=[seed, str(k)])
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID, ds.SOPInstanceUID = CT_IMAGE_STORAGE, meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study, series, frame
+        ds.Modality, ds.PatientID = "CT", "PHANTOM"
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [ox, oy, oz + k * sz]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [sy, sx]
+        ds.SliceThickness = sz
+        ds.Rows, ds.Columns = stored.shape[1:]
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 1
+        ds.RescaleSlope, ds.RescaleIntercept, ds.RescaleType = slope, inter, "HU"
+        ds.PixelData = stored[k].tobytes()
+        path = folder / f"{k + 1:04d}.dcm"
+        try:
+            pydicom.dcmwrite(path, ds, enforce_file_format=True)
+        except TypeError:                      # pydicom 2.x
+            ds.is_little_endian, ds.is_implicit_VR = True, False
+            pydicom.dcmwrite(path, ds, write_like_original=False)
+
+def make_dicom_phantom(phantom: str, slope: float) -> tuple[np.ndarray, np.ndarray]:
+    """slope 非整数时给 HU 加上棋盘状的 0.5，保证存储值确实用到这个精度"""
+    vol, aff = make_phantom(phantom)
+    if float(slope).is_integer():
+        return vol, aff
+    return vol + 0.5 * (np.indices(vol.shape).sum(axis=0) % 2), aff
+
+# ------------ 各目标的实现（backend 注册表） ------------
+# 新增的快速实现（并行、流式……）只要在这里登记一个 backend，
+# 就会自动与参考结果比较并出现在对照表中。
+P = dict(soft_hu=pipeline.DEF_SOFT_HU, top_percent=pipeline.DEF_TOP_PCT,
+         z_smooth_k=3, min_area=pipeline.DEF_MIN_AREA)
+
+def _silver_mask_serial(vol, aff):
+    m, thr = pipeline.silver_mask(vol.astype(np.float32), **P)
+    return m, thr
+
+def _silver_mask_compact(vol, aff):
+    m, thr = pipeline.silver_mask(vol, compact=True, **P)
+    return m, thr
+
+def _silver_infer_serial(vol, aff):
+    out = silver_infer(vol.astype(np.float32), soft_mask_hu=P["soft_hu"], top_percent=5.0, min_area=20)
+    return out["mask"], out["stats"]["threshold"]
+
+def _clean_serial(vol, aff):
+    return clean_small_objects_3d((vol > 100).astype(np.uint8), min_area=20), None
+
+BACKENDS: Dict[str, Dict[str, Callable]] = {
+    "silver_mask": {"serial": _silver_mask_serial, "compact": _silver_mask_compact},
+    "silver_infer": {"serial": _silver_infer_serial},
+    "clean_small_objects_3d": {"serial": _clean_serial},
+}
+
+# 读取器：输入为文件路径，输出 (HU 体积, affine)；体积比较时统一按 float64 数值比
+LOADERS: Dict[str, Dict[str, Callable]] = {
+    "main.load_any": {
+        "serial":  lambda p: pipeline.load_any(p),
+        "compact": lambda p: pipeline.load_any(p, compact=True),
+    },
+    "io_dicom.load_any": {
+        "serial":  lambda p: io_dicom.load_any(p),
+        "compact": lambda p: io_dicom.load_any(p, compact=True),
+    },
+}
+# 各读取器返回的 affine 作用在哪种下标上：zhw = 返回的 [Z,H,W] 数组；file = 文件原始轴顺序
+# （io_dicom 读 DICOM 时只给单位阵，DICOM 体模不检查它）
+LOADER_AFFINE = {"main.load_any": "zhw", "io_dicom.load_any": "file"}
+ZHW_TO_HWZ = (1, 2, 0)             # 体模按 NIfTI 惯例存成 [H,W,Z]
+AFF_ATOL   = 1e-4
+
+# ------------ 病灶指标：与逐组件的朴素计算对照 ------------
+def _labels(vol, compact: bool):
+    _, _, lab, n = pipeline.silver_mask(vol if compact else vol.astype(np.float32),
+                                        compact=compact, return_labels=True, **P)
+    return lab, n
+
+def _metrics_slab1(lab, n, vol, aff, vox):
+    """每层一块：检验跨块累加（体模整卷本来一块就装得下）"""
+    old = pipeline._METRIC_CHUNK
+    pipeline._METRIC_CHUNK = lab.shape[1] * lab.shape[2]
+    try:
+        return pipeline.lesion_metrics(lab, n, vol, aff, vox)
+    finally:
+        pipeline._METRIC_CHUNK = old
+
+# backend -> (是否用紧凑标签/体积, 实现)
+METRICS: Dict[str, tuple[bool, Callable]] = {
+    "serial":  (False, pipeline.lesion_metrics),
+    "compact": (True,  pipeline.lesion_metrics),
+    "slab1":   (False, _metrics_slab1),
+}
+
+def naive_lesions(lab: np.ndarray, n: int, vol: np.ndarray, affine: np.ndarray, vox_mm3: float) -> dict:
+    """find_objects 取包围盒，再在包围盒里逐组件直接求和/均值/最大值；返回 {label: 指标}"""
+    A = np.asarray(affine, dtype=np.float64)
+    out = {}
+    for i, sl in enumerate(ndi.find_objects(lab, max_label=n), 1):
+        if sl is None:
+            continue
+        sub = lab[sl] == i
+        hu = vol[sl][sub].astype(np.float64)
+        cen = (np.argwhere(sub) + [s.start for s in sl]).mean(axis=0)
+        v_mm3 = hu.size * vox_mm3
+        out[i] = {
+            "voxels": int(hu.size),
+            "volume_ml": v_mm3 / 1000.0,
+            "bbox_zhw": [[s.start, s.stop] for s in sl],
+            "centroid_mm": A[:3, :3] @ cen + A[:3, 3],
+            "hu_mean": float(hu.mean()),
+            "hu_max": float(hu.max()),
+            "equiv_diameter_mm": float(np.cbrt(6.0 * v_mm3 / np.pi)),
+        }
+    return out
+
+def lesions_match(got: list[dict], ref: dict) -> bool:
+    if len(got) != len(ref) or [d["rank"] for d in got] != list(range(1, len(got) + 1)):
+        return False
+    if any(a["voxels"] < b["voxels"] for a, b in zip(got, got[1:])):
+        return False                               # 须按体积从大到小
+    for d in got:
+        r = ref.get(d["label"])
+        if r is None or d["voxels"] != r["voxels"] or d["bbox_zhw"] != r["bbox_zhw"] \
+                or d["hu_max"] != r["hu_max"]:
+            return False
+        if not (np.allclose(d["centroid_mm"], r["centroid_mm"], atol=MM_ATOL)
+                and np.isclose(d["hu_mean"], r["hu_mean"], rtol=1e-9, atol=1e-9)
+                and np.isclose(d["volume_ml"], r["volume_ml"], rtol=1e-12)
+                and np.isclose(d["equiv_diameter_mm"], r["equiv_diameter_mm"], rtol=1e-12)):
+            return False
+    return True
+
+def lesions_hash(got: list[dict]) -> str:
+    return hashlib.sha256(json.dumps(got, sort_keys=True).encode()).hexdigest()
+
+# ------------ 指纹与比较 ------------
+def mask_hash(mask: np.ndarray) -> str:
+    m = np.ascontiguousarray(mask > 0)
+    h = hashlib.sha256(str(m.shape).encode())
+    h.update(np.packbits(m).tobytes())
+    return h.hexdigest()
+
+def volume_hash(vol: np.ndarray) -> str:
+    v = np.ascontiguousarray(vol, dtype=np.float64)
+    h = hashlib.sha256(str(v.shape).encode())
+    h.update(v.tobytes())
+    return h.hexdigest()
+
+def expected_dtype(vol: np.ndarray, compact: bool) -> np.dtype:
+    if compact and np.array_equal(vol, np.rint(vol)) \
+            and vol.min() >= INT16_MIN and vol.max() <= INT16_MAX:
+        return np.dtype(np.int16)
+    return np.dtype(np.float32)
+
+def dice(a: np.ndarray, b: np.ndarray) -> float:
+    a = a > 0; b = b > 0
+    s = int(a.sum()) + int(b.sum())
+    return 1.0 if s == 0 else 2.0 * int(np.count_nonzero(a & b)) / s
+
+def _ordered(impls: Dict[str, Callable]):
+    """参考实现排第一，其余实现可以与它的本次结果比对"""
+    return sorted(impls.items(), key=lambda kv: kv[0] != REF_BACKEND)
+
+def _timed(fn, *args):
+    t = time.perf_counter()
+    out = fn(*args)
+    return out, (time.perf_counter() - t) * 1000.0
+
+# ------------ 参考结果存取 ------------
+def ref_key(target: str, case: str) -> str:
+    return f"{case}__{target}"
+
+def load_refs(ref_dir: Path) -> dict:
+    p = Path(ref_dir) / "index.json"
+    return json.loads(p.read_text(encoding="utf-8")) if p.exists() else {}
+
+def save_ref(ref_dir: Path, index: dict, key: str, rec: dict, mask: np.ndarray | None):
+    ref_dir = Path(ref_dir); ref_dir.mkdir(parents=True, exist_ok=True)
+    if mask is not None:
+        m = mask > 0
+        np.savez_compressed(ref_dir / f"{key}.npz", bits=np.packbits(m), shape=np.array(m.shape))
+    index[key] = rec
+
+def load_ref_mask(ref_dir: Path, key: str) -> np.ndarray | None:
+    p = Path(ref_dir) / f"{key}.npz"
+    if not p.exists():
+        return None
+    with np.load(p) as z:
+        shape = tuple(int(s) for s in z["shape"])
+        return np.unpackbits(z["bits"], count=int(np.prod(shape))).reshape(shape).astype(bool)
+
+# ------------ 主流程 ------------
+def run(ref_dir: Path = DEF_REF_DIR, update: bool = False, samples: list[Path] | None = None) -> list[dict]:
+    index = load_refs(ref_dir)
+    rows: list[dict] = []
+
+    def record(target, case, backend, ms, *, h, voxels, thr=None, mask=None, ref=None, ref_mask=None,
+               check_ok=True):
+        row = {"target": target, "case": case, "backend": backend, "ms": ms,
+               "voxels": voxels, "thr": thr, "hash": h, "dice": None, "status": "NEW"}
+        if ref is not None:
+            same = h == ref["hash"] and voxels == ref["voxels"]
+            if thr is not None and ref.get("thr") is not None:
+                same = same and abs(thr - ref["thr"]) <= THR_ATOL
+            if mask is not None and ref_mask is not None:
+                row["dice"] = 1.0 if h == ref["hash"] else dice(mask, ref_mask)
+            row["status"] = "OK" if same else "DIFF"
+        if not check_ok:
+            row["status"] = "DIFF"        # 额外检查未通过（读取器的 affine / dtype）
+        rows.append(row)
+
+    with tempfile.TemporaryDirectory(prefix="banana_regress_") as tmp:
+        cases: list[tuple[str, Path, bool, dict | None]] = []   # (名称, 文件, 是否参与参考比对, 真实 affine)
+        for name in PHANTOMS:
+            vol, aff = make_phantom(name)
+            p = Path(tmp) / f"{name}.nii.gz"
+            # 按 NIfTI 惯例存为 [H,W,Z]（affine 的列同步换序），让读取器走真实的轴转换
+            aff_file = pipeline.reorder_affine(aff, ZHW_TO_HWZ)
+            nib.save(nib.Nifti1Image(np.transpose(vol, ZHW_TO_HWZ), aff_file), str(p))
+            cases.append((name, p, True, {"zhw": aff, "file": aff_file}))
+        for name, phantom, slope, inter in NII_SCALED_PHANTOMS:
+            vol, aff = make_phantom(phantom)
+            p = Path(tmp) / f"{name}.nii.gz"
+            aff_file = pipeline.reorder_affine(aff, ZHW_TO_HWZ)
+            stored = np.rint((vol.astype(np.float64) - inter) / slope).astype(np.int16)
+            img = nib.Nifti1Image(np.transpose(stored, ZHW_TO_HWZ), aff_file)
+            img.header.set_slope_inter(slope, inter)   # 保存时保留存储值与这组缩放，不再自动重算
+            nib.save(img, str(p))
+            cases.append((name, p, True, {"zhw": aff, "file": aff_file}))
+        for name, phantom, slope, inter in DICOM_PHANTOMS:
+            vol, aff = make_dicom_phantom(phantom, slope)
+            p = Path(tmp) / name
+            write_dicom_series(vol, aff, p, slope, inter, seed=name)
+            cases.append((name, p, True, {"zhw": aff, "file": None}))
+        for s in samples or []:
+            cases.append((Path(s).name, Path(s), False, None))
+
+        for case, path, compare, true_aff in cases:
+            # 1) 读取器：各实现读出的 HU 必须逐体素一致，affine 必须与体模几何一致，
+            #    dtype 与模式相符（默认 float32；compact 能无损就 int16，否则 float32）
+            vol = aff = None
+            for target, impls in LOADERS.items():
+                key = ref_key(target, case)
+                ref = index.get(key) if compare and not update else None
+                for backend, fn in _ordered(impls):
+                    (v, a), ms = _timed(fn, path)
+                    rec = {"hash": volume_hash(v), "voxels": int(v.size)}
+                    exp = true_aff and true_aff[LOADER_AFFINE[target]]
+                    ok = exp is None or np.allclose(np.asarray(a, dtype=np.float64), exp, atol=AFF_ATOL)
+                    ok = ok and v.dtype == expected_dtype(v, compact=backend == "compact")
+                    if compare and update and backend == REF_BACKEND:
+                        save_ref(ref_dir, index, key, rec, None)
+                    record(target, case, backend, ms, h=rec["hash"], voxels=rec["voxels"], ref=ref,
+                           check_ok=ok)
+                    if ref is None and backend == REF_BACKEND:
+                        ref = rec             # 没有保存的参考时，与本次参考实现比
+                    if vol is None:
+                        vol, aff = v, a
+            vol_i16 = to_int16_if_lossless(np.asarray(vol))
+
+            # 2) 分割相关目标
+            for target, impls in BACKENDS.items():
+                key = ref_key(target, case)
+                ref = index.get(key) if compare and not update else None
+                ref_mask = load_ref_mask(ref_dir, key) if ref is not None else None
+                for backend, fn in _ordered(impls):
+                    (m, thr), ms = _timed(fn, vol_i16, aff)
+                    rec = {"hash": mask_hash(m), "voxels": int(np.count_nonzero(m)),
+                           "thr": None if thr is None else float(thr)}
+                    if compare and update and backend == REF_BACKEND:
+                        save_ref(ref_dir, index, key, rec, m)
+                    record(target, case, backend, ms, h=rec["hash"], voxels=rec["voxels"],
+                           thr=rec["thr"], mask=m, ref=ref, ref_mask=ref_mask)
+                    if ref is None and backend == REF_BACKEND:
+                        ref, ref_mask = rec, m
+
+            # 3) 病灶指标：参考是逐组件的朴素计算（体模用真实 affine，顺带检查轴顺序）
+            vox = pipeline.voxel_volume_mm3(aff)
+            geo = true_aff["zhw"] if true_aff else aff
+            labels = {c: _labels(vol_i16, c) for c in (False, True)}
+            expect = naive_lesions(*labels[False], vol_i16, geo, vox)
+            for backend, (c, fn) in _ordered(METRICS):
+                lab, n = labels[c]
+                got, ms = _timed(fn, lab, n, vol_i16 if c else vol_i16.astype(np.float32), aff, vox)
+                record("lesion_metrics", case, backend, ms, h=lesions_hash(got),
+                       voxels=sum(d["voxels"] for d in got), ref=None)
+                rows[-1]["status"] = "OK" if lesions_match(got, expect) else "DIFF"
+
+    if update:
+        Path(ref_dir).mkdir(parents=True, exist_ok=True)
+        (Path(ref_dir) / "index.json").write_text(
+            json.dumps(index, ensure_ascii=False, indent=2, sort_keys=True), encoding="utf-8")
+    return rows
+
+def format_table(rows: list[dict]) -> str:
+    cols = ["target", "case", "backend", "ms", "speedup", "voxels", "thr", "hash", "dice", "status"]
+    # 相对同一 (target, case) 下参考实现的加速比
+    base = {(r["target"], r["case"]): r["ms"] for r in rows if r["backend"] == REF_BACKEND}
+    lines = []
+    for r in rows:
+        b = base.get((r["target"], r["case"]))
+        lines.append([
+            r["target"], r["case"], r["backend"], f"{r['ms']:.1f}",
+            f"{b / r['ms']:.2f}x" if b and r["ms"] > 0 else "-",
+            str(r["voxels"]),
+            "-" if r["thr"] is None else f"{r['thr']:.4f}",
+            r["hash"][:12],
+            "-" if r["dice"] is None else f"{r['dice']:.6f}",
+            r["status"],
+        ])
+    widths = [max(len(c), *(len(l[i]) for l in lines)) if lines else len(c) for i, c in enumerate(cols)]
+    fmt = "  ".join(f"{{:<{w}}}" for w in widths)
+    out = [fmt.format(*cols), fmt.format(*("-" * w for w in widths))]
+    out += [fmt.format(*l) for l in lines]
+    return "\n".join(out)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ref_dir", default=str(DEF_REF_DIR), help="参考结果目录")
+    ap.add_argument("--update", action="store_true", help="用参考实现重新生成参考结果")
+    ap.add_argument("--sample", action="append", default=[], help="额外的样例输入（可多次指定）")
+    ap.add_argument("--json", default=None, help="另存结果表为 JSON")
+    args = ap.parse_args()
+
+    rows = run(Path(args.ref_dir), update=args.update, samples=[Path(s) for s in args.sample])
+    print(format_table(rows))
+    if args.json:
+        Path(args.json).write_text(json.dumps(rows, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    n_diff = sum(r["status"] == "DIFF" for r in rows)
+    pipeline.log(f"共 {len(rows)} 项，不一致 {n_diff} 项" + ("（已更新参考）" if args.update else ""))
+    sys.exit(1 if n_diff else 0)
+
+if __name__ == "__main__":
+    main()
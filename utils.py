@@ -5,6 +5,8 @@ from typing import Tuple, Optional
 import numpy as np
 import nibabel as nib
 
+INT16_MIN, INT16_MAX = np.iinfo(np.int16).min, np.iinfo(np.int16).max
+
 def ensure_dir(p: Path) -> Path:
     p = Path(p)
     p.mkdir(parents=True, exist_ok=True)
@@ -35,6 +37,24 @@ def save_nifti_like(volume_np: np.ndarray, ref_affine: Optional[np.ndarray], out
     img = nib.Nifti1Image(hwz.astype(np.float32), affine)
     nib.save(img, str(out_path))
 
+def to_int16_if_lossless(arr: np.ndarray) -> np.ndarray:
+    """
+    HU 能无损放进 int16 就转 int16（CT 原始像素本来就是 2 字节），
+    否则退回 float32（与默认路径相同，不会留下 float64 / int32 这类更大的 dtype）。
+    """
+    if arr.dtype == np.int16:
+        return arr
+    if arr.size == 0:
+        return arr.astype(np.int16)
+    lo, hi = arr.min(), arr.max()
+    if lo < INT16_MIN or hi > INT16_MAX:
+        return arr.astype(np.float32, copy=False)
+    if arr.dtype.kind in "iub":
+        return arr.astype(np.int16)
+    if arr.dtype.kind == "f" and np.array_equal(arr, np.rint(arr)):
+        return arr.astype(np.int16)
+    return arr.astype(np.float32, copy=False)
+
 def percentile_thresh(x: np.ndarray, q: float) -> float:
     return float(np.percentile(x.reshape(-1), q))
 
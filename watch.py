@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+r"""
+Banana — 监听目录（watch）模式
+- 轮询共享目录，发现新的 zip / DICOM 文件夹 / .nii(.gz) 后自动跑 main.py 的流水线
+- 输入“写完”的判定：存在同名标记文件 <名字>.done，或大小/mtime 连续 stable_secs 秒不变
+- 按内容哈希去重，已处理过的内容不会重复跑
+- 有界进程池并行；队列与已处理记录落盘到 <out>/.watch_state.json，重启后自动恢复
+
+用法：
+  python watch.py --watch_dir "<共享目录>" --out "outputs" [--workers 2]
+
+其余流水线参数（--hu_lo / --soft_lo / --top_percent ...）与 main.py 相同。
+"""
+from __future__ import annotations
+import os, json, time, queue, hashlib, argparse, threading, multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.util import Finalize
+from pathlib import Path
+
+from main import log, add_pipeline_args
+
+STATE_NAME  = ".watch_state.json"
+MARKER_EXT  = ".done"
+INPUT_EXTS  = (".zip", ".nii", ".nii.gz", ".mgz", ".mgh")
+MAX_CRASHES = 3      # 同一输入遇到工作进程崩溃（如 OOM）的次数上限，超过才记为失败
+
+# ------------ 输入发现 ------------
+def is_candidate(p: Path) -> bool:
+    name = p.name.lower()
+    if name.startswith(".") or name.endswith(MARKER_EXT):
+        return False
+    if p.is_dir():
+        return True
+    return any(name.endswith(ext) for ext in INPUT_EXTS)
+
+def signature(p: Path) -> tuple[int, int, int]:
+    """
+    只用 stat 的轻量签名：(文件数, 总字节数, 最大 mtime_ns)。
+    文件夹会递归统计，扫描方向上不读任何文件内容。
+    """
+    if p.is_file():
+        st = p.stat()
+        return (1, st.st_size, st.st_mtime_ns)
+    n = size = mt = 0
+    for root, _, files in os.walk(p):
+        for f in files:
+            try:
+                st = os.stat(os.path.join(root, f))
+            except OSError:
+                continue
+            n += 1; size += st.st_size; mt = max(mt, st.st_mtime_ns)
+    return (n, size, mt)
+
+def top_stat(p: Path) -> tuple[int, int]:
+    """只看顶层的一次 stat：(大小, mtime_ns)。文件夹里增删文件会改变其 mtime。"""
+    st = p.stat()
+    return (st.st_size, st.st_mtime_ns)
+
+def content_hash(p: Path) -> str:
+    """内容哈希（sha256）；文件夹按相对路径排序后逐个哈希文件名与内容。"""
+    h = hashlib.sha256()
+
+    def feed(fp: Path):
+        with open(fp, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+
+    if p.is_file():
+        feed(p)
+    else:
+        files = sorted(q for q in p.rglob("*") if q.is_file())
+        for q in files:
+            h.update(q.relative_to(p).as_posix().encode("utf-8"))
+            feed(q)
+    return h.hexdigest()
+
+# ------------ 状态持久化 ------------
+def load_state(out_dir: Path) -> dict:
+    p = Path(out_dir) / STATE_NAME
+    if p.exists():
+        try:
+            st = json.loads(p.read_text(encoding="utf-8"))
+            st.setdefault("done", {})
+            st.setdefault("failed", {})
+            st.setdefault("queue", [])
+            return st
+        except Exception as e:
+            log(f"[watch] 状态文件损坏，忽略：{e}")
+    return {"done": {}, "failed": {}, "queue": []}
+
+def save_state(out_dir: Path, state: dict):
+    """先写临时文件再替换，断电/崩溃时不会留下半截 JSON。"""
+    p = Path(out_dir) / STATE_NAME
+    tmp = p.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, p)
+
+# ------------ 进程池任务 ------------
+# 每个工作进程一个后台导出器，跨病例复用；一个病例的产物写完后由回报线程把结果放进
+# _REPORTS，主进程据此把病例从“JSON 已落盘”推进到“产物齐全”
+_EXPORTER = None
+_REPORTS  = None
+_FLUSHING = None   # 上一个病例的回报线程
+
+def _init_worker(reports):
+    global _REPORTS
+    _REPORTS = reports
+    # 工作进程退出时不等普通线程：先把最后一个病例的产物写完并回报。
+    # 优先级要高于回报队列自己的收尾（exitpriority=10），否则回报会排在队列的结束标记之后被丢掉
+    Finalize(None, _flush_exports, exitpriority=100)
+
+def _flush_exports():
+    if _FLUSHING is not None:
+        _FLUSHING.join()
+
+def _report_exports(key: str):
+    from main import report_export_failures
+    failed = _EXPORTER.wait()
+    report_export_failures(failed)
+    # 异常对象不一定能 pickle，只回报产物名
+    _REPORTS.put((key, [name for name, _ in failed]))
+
+def _run_one(inp: str, out_dir: str, params: dict, key: str) -> str:
+    """
+    跑一个病例：JSON 同步落盘后就返回（主进程记为 JSON 已落盘），各产物由导出线程接着写，
+    写完后经 _REPORTS 回报。开始新病例前先等上一个病例的产物写完，
+    工作进程里最多只有一个病例的产物在写，不会积压多个病例的体积数据。
+    """
+    global _EXPORTER, _FLUSHING
+    from main import process_case
+    from export import AsyncExporter
+    if _EXPORTER is None:
+        _EXPORTER = AsyncExporter()
+    _flush_exports()
+    try:
+        rep = process_case(Path(inp), Path(out_dir), argparse.Namespace(**params), exporter=_EXPORTER)
+    finally:
+        # 病例出错时已提交的产物也照常写完，不会混进下一个病例
+        _FLUSHING = threading.Thread(target=_report_exports, args=(key,), name="export-report")
+        _FLUSHING.start()
+    return str(rep)
+
+# ------------ 主循环 ------------
+class Watcher:
+    def __init__(self, watch_dir: Path, out_dir: Path, params: dict, *,
+                 workers: int = 2, interval: float = 2.0, stable_secs: float = 5.0):
+        # 状态里存绝对路径，换个工作目录重启也能找到
+        self.watch_dir = Path(watch_dir).resolve()
+        self.out_dir = Path(out_dir).resolve(); self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.params = params
+        self.workers = max(1, int(workers))
+        self.interval = float(interval)
+        self.stable_secs = float(stable_secs)
+
+        self.state = load_state(self.out_dir)
+        # 重启恢复：上次排队或正在跑的条目重新入队
+        self.pending = deque(self.state["queue"])
+        self.queued = {it["hash"] for it in self.pending}
+        self.seen: dict[str, tuple] = {}     # 路径 -> (签名, 首次见到该签名的时间)
+        self.skip: dict[str, tuple] = {}     # 路径 -> 已入队/已跳过时的顶层 stat，不变就不再遍历和哈希
+        self.early: dict[str, list] = {}     # 哈希 -> 先于任务结果到达的产物回报
+        self.reports = None
+        self._requeue_unconfirmed()
+        if self.pending:
+            log(f"[watch] 恢复队列：{len(self.pending)} 项")
+
+    def _persist(self, running: dict):
+        self.state["queue"] = [it for it in running.values()] + list(self.pending)
+        save_state(self.out_dir, self.state)
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # 每个池配一个新的回报队列：被杀的工作进程可能让旧队列处于半写状态
+        self.reports = multiprocessing.Queue()
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=_init_worker, initargs=(self.reports,))
+
+    def _collect_reports(self) -> bool:
+        """取走已到达的产物回报；返回是否有状态变化。"""
+        changed = False
+        while True:
+            try:
+                key, failed = self.reports.get_nowait()
+            except queue.Empty:
+                return changed
+            self._artifacts(key, failed)
+            changed = True
+
+    def _artifacts(self, key: str, failed: list):
+        entry = self.state["done"].get(key)
+        if entry is None:
+            if key not in self.state["failed"]:
+                self.early[key] = failed      # 回报比任务结果先到，_finish 时再记
+            return
+        if failed:
+            self.state["done"].pop(key)
+            self._fail({"path": entry["input"], "hash": key}, "产物导出失败：" + "，".join(failed))
+        else:
+            entry["artifacts"] = "complete"
+
+    def _requeue_unconfirmed(self):
+        """
+        JSON 已落盘、但产物没确认写完的病例（工作进程被杀，或上次没有正常退出）重新入队；
+        旧状态文件里没有 artifacts 字段的记录视为已齐全。
+        """
+        for h, d in list(self.state["done"].items()):
+            if d.get("artifacts") != "json" or h in self.queued:
+                continue
+            self.state["done"].pop(h)
+            self.pending.append({"path": d["input"], "hash": h})
+            self.queued.add(h)
+            log(f"[watch] 产物未确认写完，重新排队：{Path(d['input']).name}")
+
+    def _ready(self, p: Path, now: float) -> bool:
+        key = str(p)
+        if key in self.skip:
+            # 已处理过的条目只做一次顶层 stat，不递归遍历文件夹（空闲时开销不随目录增长）
+            try:
+                if top_stat(p) == self.skip[key]:
+                    return False
+            except OSError:
+                return False
+            self.skip.pop(key)
+        try:
+            sig = signature(p)
+        except OSError:
+            return False
+        if p.with_name(p.name + MARKER_EXT).exists():
+            return True
+        prev = self.seen.get(key)
+        if prev is None or prev[0] != sig:
+            self.seen[key] = (sig, now)
+            return False
+        return now - prev[1] >= self.stable_secs
+
+    def scan(self) -> int:
+        """扫一遍 watch_dir，把写完且未处理过的输入放进队列。返回新增数量。"""
+        now = time.monotonic()
+        added = 0
+        try:
+            entries = list(os.scandir(self.watch_dir))
+        except FileNotFoundError:
+            return 0
+        alive = set()
+        for e in entries:
+            p = Path(e.path)
+            if not is_candidate(p):
+                continue
+            alive.add(str(p))
+            if not self._ready(p, now):
+                continue
+            self.skip[str(p)] = top_stat(p)
+            self.seen.pop(str(p), None)
+            h = content_hash(p)
+            if h in self.state["done"] or h in self.state["failed"] or h in self.queued:
+                log(f"[watch] 跳过（内容已处理）：{p.name}")
+                continue
+            self.pending.append({"path": str(p), "hash": h})
+            self.queued.add(h)
+            added += 1
+            log(f"[watch] 入队：{p.name}")
+        # 已消失的路径不再跟踪
+        for d in (self.seen, self.skip):
+            for k in [k for k in d if k not in alive]:
+                d.pop(k)
+        return added
+
+    def _finish(self, fut, it: dict) -> bool:
+        """处理一个结束的任务；返回 True 表示进程池已坏、需要重建。"""
+        try:
+            rep = fut.result()
+        except BrokenProcessPool as e:
+            # 工作进程被杀（常见是 OOM）：同池里在跑的病例都会收到这个异常，
+            # 不一定是该输入的问题，放回队首单独重试；单独跑也反复崩溃才记为失败
+            it["crashes"] = it.get("crashes", 0) + 1
+            if it["crashes"] >= MAX_CRASHES:
+                self._fail(it, f"工作进程连续崩溃 {it['crashes']} 次：{e}")
+            else:
+                log(f"[watch] 工作进程崩溃，重新排队：{Path(it['path']).name}（第 {it['crashes']} 次）")
+                self.pending.appendleft(it)
+            return True
+        except Exception as e:
+            self._fail(it, str(e))
+            return False
+        self.queued.discard(it["hash"])
+        # 先记为 JSON 已落盘（artifacts=json）；产物回报到达后改为 complete，失败则移到 failed
+        self.state["done"][it["hash"]] = {
+            "input": it["path"], "report": Path(rep).name,
+            "at": time.strftime("%Y%m%d_%H%M%S"), "artifacts": "json",
+        }
+        self.state["failed"].pop(it["hash"], None)
+        if it["hash"] in self.early:
+            self._artifacts(it["hash"], self.early.pop(it["hash"]))
+        return False
+
+    def _fail(self, it: dict, err: str):
+        # 失败的内容记录下来；内容变化（哈希改变）后才会重新入队
+        log(f"[watch] 失败：{Path(it['path']).name}  {err}")
+        self.queued.discard(it["hash"])
+        self.early.pop(it["hash"], None)
+        self.state["failed"][it["hash"]] = {"input": it["path"], "error": err}
+
+    def run(self, once: bool = False):
+        log(f"[watch] 监听 {self.watch_dir} → {self.out_dir}（workers={self.workers}）")
+        running: dict = {}
+        ex = self._new_pool()
+        broken = False
+        try:
+            while True:
+                if broken and not running:
+                    ex.shutdown(wait=False, cancel_futures=True)
+                    # 池里的工作进程都已退出，没回报的病例产物可能没写完
+                    self._collect_reports()
+                    self._requeue_unconfirmed()
+                    ex = self._new_pool()
+                    broken = False
+                    log("[watch] 已重建进程池")
+                changed = self.scan() > 0
+                changed |= self._collect_reports()
+
+                # 有界提交：同时在跑的任务不超过 workers 个，其余留在 pending
+                while self.pending and len(running) < self.workers:
+                    # 崩溃过的输入单独跑：再崩溃就能确定是它自己的问题，不连累同池的其它病例
+                    if running and (self.pending[0].get("crashes") or
+                                    any(r.get("crashes") for r in running.values())):
+                        break
+                    it = self.pending.popleft()
+                    try:
+                        fut = ex.submit(_run_one, it["path"], str(self.out_dir), self.params, it["hash"])
+                    except BrokenProcessPool:
+                        # 池在两次轮询之间坏掉：放回去，等在跑的任务收尾后重建
+                        self.pending.appendleft(it)
+                        broken = True
+                        break
+                    running[fut] = it
+                    changed = True
+                if changed:
+                    self._persist(running)
+
+                if running:
+                    done, _ = wait(list(running), timeout=self.interval, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        broken |= self._finish(fut, running.pop(fut))
+                    if broken:
+                        # 坏掉的池里其余任务也会立刻以 BrokenProcessPool 结束，一并收回，下一轮重建
+                        for fut in list(running):
+                            self._finish(fut, running.pop(fut))
+                    if done:
+                        self._persist(running)
+                elif once and not self.pending and not self.seen and not broken:
+                    break
+                else:
+                    # 空闲：只做 stat 轮询，睡眠间隔内不占 CPU
+                    time.sleep(self.interval)
+        finally:
+            # 工作进程退出前会写完手上的产物并回报，收齐后再落盘一次
+            ex.shutdown(wait=True)
+            self._collect_reports()
+            self._persist(running)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--watch_dir", required=True, help="扫描仪桥接投放 zip / DICOM 文件夹 / .nii 的共享目录")
+    ap.add_argument("--out",       required=True, help="输出目录（与 main.py 相同布局）")
+    ap.add_argument("--workers",   type=int,   default=2,   help="并行处理的病例数上限")
+    ap.add_argument("--interval",  type=float, default=2.0, help="轮询间隔（秒）")
+    ap.add_argument("--stable_secs", type=float, default=5.0, help="大小/mtime 持续不变多少秒视为写完")
+    ap.add_argument("--once", action="store_true", help="处理完当前目录里已写完的输入后退出")
+    add_pipeline_args(ap)
+    args = ap.parse_args()
+
+    params = {k: v for k, v in vars(args).items()
+              if k not in ("watch_dir", "out", "workers", "interval", "stable_secs", "once")}
+    Watcher(Path(args.watch_dir), Path(args.out), params,
+            workers=args.workers, interval=args.interval, stable_secs=args.stable_secs).run(once=args.once)
+
+if __name__ == "__main__":
+    main()